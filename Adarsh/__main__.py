@@ -15,6 +15,9 @@ from .vars import Var
 from aiohttp import web
 from .server import web_server
 from .utils.keepalive import ping_server
+from .utils.session_pool import media_sessions, cdn_sessions
+from .utils.custom_dl import probe_dcs
+from .utils.mirror import mirror
 from Adarsh.bot.clients import initialize_clients
 
 # -------------------------------------------------------------------
@@ -125,6 +128,9 @@ async def start_services():
         logging.info("------------------ Starting Keep Alive Service ------------------")
         asyncio.create_task(ping_server())
 
+    if Var.DC_PROBE_INTERVAL:
+        asyncio.create_task(probe_dcs())
+
     # ------------------- Start aiohttp web server -------------------
     logging.info('-------------------- Initializing Web Server --------------------')
     runner = web.AppRunner(await web_server())
@@ -150,6 +156,9 @@ async def start_services():
     await stop_event.wait()
 
     # Graceful shutdown
+    await mirror.stop()
+    await media_sessions.stop()
+    await cdn_sessions.stop()
     await StreamBot.stop()
     await runner.cleanup()
     logging.info('----------------------- Service Stopped -----------------------')
@@ -2,6 +2,7 @@
 from pyrogram import Client
 import pyromod.listen
 from ..vars import Var
+from ..utils.client_scheduler import ClientScheduler
 from os import getcwd
 
 StreamBot = Client(
@@ -15,3 +16,4 @@ StreamBot = Client(
 
 multi_clients = {}
 work_loads = {}
+scheduler = ClientScheduler(Var.CLIENT_SCHEDULER)
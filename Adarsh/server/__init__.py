@@ -1,11 +1,99 @@
 # © agrprojects
 
+import time
 from aiohttp import web
-from .stream_routes import routes
+from Adarsh.vars import Var
+from Adarsh.bot import scheduler
+from Adarsh.utils import metrics
+from Adarsh.utils.metrics import Counter, Gauge, http_responses, http_ttfb_seconds
+from Adarsh.utils.file_cache import file_cache
+from Adarsh.utils.part_cache import part_cache
+from Adarsh.utils.bandwidth import bandwidth
+from Adarsh.utils.admission import admission
+from Adarsh.utils.session_pool import media_sessions, cdn_sessions
+from .stream_routes import routes, is_admin
+
+# values kept by the caches and the scheduler, read only when /metrics is scraped
+Gauge(
+    "stream_in_flight", "Streams being served", ["client"],
+    collect=lambda: {(f"bot{i + 1}",): s.streams for i, s in scheduler.stats.items()},
+)
+Gauge(
+    "stream_in_flight_bytes", "Bytes left to send of the streams being served", ["client"],
+    collect=lambda: {(f"bot{i + 1}",): s.bytes_in_flight for i, s in scheduler.stats.items()},
+)
+Counter(
+    "file_cache_requests_total", "File properties lookups by outcome", ["result"],
+    collect=lambda: {("hit",): file_cache.hits, ("miss",): file_cache.misses, ("missing",): file_cache.missing_hits},
+)
+Counter(
+    "part_cache_requests_total", "Part cache lookups by outcome", ["result"],
+    collect=lambda: {("hit",): part_cache.hits, ("miss",): part_cache.misses},
+)
+Gauge("part_cache_bytes", "Bytes held by the part cache", collect=lambda: {(): part_cache.size})
+Counter(
+    "media_sessions_created_total", "Media sessions created", ["pool"],
+    collect=lambda: {("media",): media_sessions.created, ("cdn",): cdn_sessions.created},
+)
+
+Gauge(
+    "bandwidth_flows", "Streams going through the bandwidth scheduler", ["priority"],
+    collect=lambda: {(p,): n for p, n in bandwidth.flows.items()},
+)
+Gauge("bandwidth_waiting", "Streams waiting for bandwidth", collect=lambda: {(): bandwidth.waiting})
+Gauge(
+    "bandwidth_allocation_bytes_per_second", "Share of BANDWIDTH_LIMIT given to every priority", ["priority"],
+    collect=lambda: {(p,): rate for p, rate in bandwidth.allocations().items()},
+)
+
+Gauge("admission_active_streams", "Streams let in by admission control", collect=lambda: {(): admission.active})
+Gauge(
+    "admission_client_streams", "Streams let in by admission control for every bot", ["client"],
+    collect=lambda: {(f"bot{i + 1}",): n for i, n in admission.clients.items()},
+)
+Gauge("admission_queued_streams", "Streams waiting for admission", collect=lambda: {(): admission.queued})
+Gauge(
+    "admission_buffered_bytes", "Bytes reserved by the streams let in", collect=lambda: {(): admission.buffered}
+)
+Counter(
+    "admission_rejected_total", "Streams refused by admission control", ["reason"],
+    collect=lambda: {(reason,): n for reason, n in admission.rejected.items()},
+)
+
+
+def route_name(request: web.Request) -> str:
+    resource = request.match_info.route.resource
+    return resource.canonical if resource is not None else "unmatched"
+
+
+@web.middleware
+async def metrics_middleware(request: web.Request, handler):
+    request["started"] = time.monotonic()
+    try:
+        response = await handler(request)
+    except web.HTTPException as e:
+        http_responses.labels(route_name(request), e.status).inc()
+        raise
+    http_responses.labels(route_name(request), response.status).inc()
+    return response
+
+
+async def on_response_prepare(request: web.Request, response: web.StreamResponse):
+    started = request.get("started")
+    if started is not None:
+        http_ttfb_seconds.labels(route_name(request)).observe(time.monotonic() - started)
+
+
+async def metrics_handler(request: web.Request):
+    if Var.ADMIN_TOKEN and not is_admin(request):
+        return web.HTTPForbidden(text="Invalid token")
+    return web.Response(text=metrics.render(), content_type="text/plain", headers={"Cache-Control": "no-store"})
 
 
 async def web_server():
-    web_app = web.Application(client_max_size=30000000)
+    web_app = web.Application(client_max_size=30000000, middlewares=[metrics_middleware])
+    web_app.on_response_prepare.append(on_response_prepare)
+    # added first, the file route matches every path
+    web_app.router.add_get("/metrics", metrics_handler)
     web_app.add_routes(routes)
     return web_app
-
@@ -3,4 +3,13 @@ class InvalidHash(Exception):
     message = "Invalid hash"
 
 class FIleNotFound(Exception):
-    message = "File not found"
\ No newline at end of file
+    message = "File not found"
+
+class Overloaded(Exception):
+    message = "Too many streams, try again later"
+
+    def __init__(self, status: int, retry_after: float):
+        super().__init__(self.message)
+        # 503 when the server is full, 429 when the viewer has too many streams
+        self.status = status
+        self.retry_after = retry_after
@@ -0,0 +1,79 @@
+import re
+from typing import List, Optional, Tuple
+
+# more ranges than this in one request are treated as an abuse and the whole file is sent
+MAX_RANGES = 16
+
+_range_spec = re.compile(r"^\s*(\d*)\s*-\s*(\d*)\s*$")
+
+
+def parse_range(range_header: Optional[str], file_size: int) -> Optional[List[Tuple[int, int]]]:
+    """
+    Parses a Range header following RFC 7233 into a sorted list of inclusive (start, end) byte ranges.
+    returns None when the header is missing or can't be used, the whole file should then be sent,
+    and an empty list when none of the ranges can be satisfied.
+    Open ranges (bytes=100-), suffix ranges (bytes=-500) and multiple ranges are supported,
+    overlapping or adjacent ranges are merged.
+    """
+    if not range_header:
+        return None
+    unit, _, specs = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or not specs:
+        return None
+
+    ranges = []
+    for spec in specs.split(","):
+        if not spec.strip():
+            continue
+        match = _range_spec.match(spec)
+        if not match:
+            return None
+        first, last = match.groups()
+        if first:
+            start = int(first)
+            end = int(last) if last else file_size - 1
+            if last and end < start:
+                return None
+            if start >= file_size:
+                continue
+            end = min(end, file_size - 1)
+        elif last:
+            suffix = int(last)
+            if suffix == 0:
+                continue
+            start = max(file_size - suffix, 0)
+            end = file_size - 1
+        else:
+            return None
+        if end >= start:
+            ranges.append((start, end))
+
+    if len(ranges) > MAX_RANGES:
+        return None
+
+    ranges.sort()
+    merged: List[Tuple[int, int]] = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def multipart_headers(boundary: str, mime_type: str, ranges: List[Tuple[int, int]], file_size: int) -> List[bytes]:
+    """
+    Returns the header block written before every part of a multipart/byteranges body.
+    """
+    return [
+        (
+            f"\r\n--{boundary}\r\n"
+            f"Content-Type: {mime_type}\r\n"
+            f"Content-Range: bytes {start}-{end}/{file_size}\r\n\r\n"
+        ).encode()
+        for start, end in ranges
+    ]
+
+
+def multipart_trailer(boundary: str) -> bytes:
+    return f"\r\n--{boundary}--\r\n".encode()
@@ -7,14 +7,35 @@ import math
 import logging
 import secrets
 import mimetypes
+import asyncio
+import email.utils
+import urllib.parse
+from contextlib import aclosing
+from typing import Optional
 from aiohttp import web
 from aiohttp.http_exceptions import BadStatusLine
-from Adarsh.bot import multi_clients, work_loads, StreamBot
-from Adarsh.server.exceptions import FIleNotFound, InvalidHash
+from aiohttp.web_fileresponse import NOSENDFILE
+from Adarsh.bot import multi_clients, work_loads, scheduler, StreamBot
+from Adarsh.server.exceptions import FIleNotFound, InvalidHash, Overloaded
+from Adarsh.server.ranges import parse_range, multipart_headers, multipart_trailer
 from Adarsh import StartTime, __version__
 from ..utils.time_format import get_readable_time
-from ..utils.custom_dl import ByteStreamer, offset_fix, chunk_size
+from ..utils.custom_dl import ByteStreamer, offset_fix, PART_SIZE
+from ..utils.dc_stats import dc_stats, MAX_PART_SIZE, MIN_PART_SIZE
+from ..utils.cdn import CdnFile, cdn_files
+from ..utils.part_cache import part_cache
+from ..utils.prefetch import prefetcher
+from ..utils.mirror import mirror
+from ..utils.popularity import popularity
 from Adarsh.utils.render_template import render_page
+from Adarsh.utils.file_cache import file_cache
+from Adarsh.utils.message_loader import message_loader
+from Adarsh.utils.rate_limit import bad_requests
+from Adarsh.utils.bandwidth import bandwidth, Flow
+from Adarsh.utils.admission import admission
+from Adarsh.utils.signed_links import link_path, seconds_left, verify
+from Adarsh.utils.tracing import current_trace, span, start_trace
+from Adarsh.utils.metrics import wasted_bytes, sent_bytes
 from Adarsh.vars import Var
 
 routes = web.RouteTableDef()
@@ -42,32 +63,100 @@ async def root_route_handler(_):
                     sorted(work_loads.items(), key=lambda x: x[1], reverse=True)
                 )
             ),
+            "scheduler": scheduler.snapshot(),
+            "file_cache": file_cache.stats(),
+            "message_loader": message_loader.stats(),
+            "bad_requests": bad_requests.stats(),
+            "wasted_bytes": wasted_bytes.value,
+            "prefetched_bytes": prefetcher.prefetched,
+            "mirror": mirror.stats(),
+            "bandwidth": bandwidth.stats(),
+            "admission": admission.stats(),
+            "dcs": dc_stats.snapshot(),
             "version": __version__,
         }
     )
 
 
+def is_admin(request: web.Request) -> bool:
+    """
+    Checks the ADMIN_TOKEN given as a bearer token or in the token query parameter.
+    """
+    token = request.headers.get("Authorization", "").removeprefix("Bearer ") or request.query.get("token", "")
+    return bool(Var.ADMIN_TOKEN) and secrets.compare_digest(token.encode(), Var.ADMIN_TOKEN.encode())
+
+
+def client_ip(request: web.Request) -> Optional[str]:
+    """
+    Returns the IP of the viewer. Behind TRUSTED_PROXIES proxies, like the router of Heroku or Koyeb,
+    it is the address the first of them, the one the viewer connected to, put in X-Forwarded-For,
+    request.remote being the proxy.
+    """
+    if not Var.TRUSTED_PROXIES:
+        return request.remote
+    # the entries before the ones our proxies added come from the viewer and can be forged
+    forwarded = [
+        ip.strip() for header in request.headers.getall("X-Forwarded-For", ()) for ip in header.split(",") if ip.strip()
+    ]
+    if len(forwarded) < Var.TRUSTED_PROXIES:
+        return request.remote
+    return forwarded[-Var.TRUSTED_PROXIES]
+
+
+def refuse_bad_client(request: web.Request):
+    """
+    Returns a 429 response for an IP that got too many 403 and 404 answers lately, so scanners
+    and stale links are turned away before any Telegram call.
+    """
+    retry_after = bad_requests.retry_after(client_ip(request))
+    if retry_after:
+        return web.Response(
+            status=429, text="Too many invalid requests", headers={"Retry-After": str(math.ceil(retry_after))}
+        )
+    return None
+
+
+def parse_path(request: web.Request):
+    """
+    Returns the message ID, the hash and the signature of a link.
+    A signature is checked here, before anything is asked from Telegram, and is None for hash links.
+    """
+    path = request.match_info["path"]
+    match = re.search(r"^([a-zA-Z0-9_-]{6})(\d+)$", path)
+    if match:
+        secure_hash = match.group(1)
+        file_id = int(match.group(2))
+    else:
+        file_id = int(re.search(r"(\d+)(?:\/\S+)?", path).group(1))
+        secure_hash = request.rel_url.query.get("hash")
+    signature = None if match else request.rel_url.query.get("sig")
+    if signature is not None and not verify(file_id, signature):
+        logger.debug(f"Invalid signature for message ID {file_id}")
+        raise InvalidHash
+    return file_id, secure_hash, signature
+
+
 # ------------------------------
 # /watch/{path} route
 # ------------------------------
 @routes.get(r"/watch/{path:\S+}", allow_head=True)
 async def watch_handler(request: web.Request):
+    refused = refuse_bad_client(request)
+    if refused is not None:
+        return refused
     try:
-        path = request.match_info["path"]
-        match = re.search(r"^([a-zA-Z0-9_-]{6})(\d+)$", path)
-        if match:
-            secure_hash = match.group(1)
-            file_id = int(match.group(2))
-        else:
-            file_id = int(re.search(r"(\d+)(?:\/\S+)?", path).group(1))
-            secure_hash = request.rel_url.query.get("hash")
+        file_id, secure_hash, signature = parse_path(request)
 
-        content = await render_page(file_id, secure_hash)
-        return web.Response(text=content, content_type="text/html")
+        content = await render_page(file_id, secure_hash, signature)
+        return web.Response(
+            text=content, content_type="text/html", headers={"Cache-Control": Var.PAGE_CACHE_CONTROL}
+        )
 
     except InvalidHash as e:
+        bad_requests.failed(client_ip(request))
         return web.HTTPForbidden(text=str(e))
     except FIleNotFound as e:
+        bad_requests.failed(client_ip(request))
         return web.HTTPNotFound(text=str(e))
     except (AttributeError, BadStatusLine, ConnectionResetError) as e:
         logger.warning(f"Ignored exception: {e}")
@@ -77,33 +166,102 @@ async def watch_handler(request: web.Request):
         return web.HTTPInternalServerError(text=str(e))
 
 
+# ------------------------------
+# /meta/{path} route
+# ------------------------------
+@routes.get(r"/meta/{path:\S+}", allow_head=True)
+async def meta_handler(request: web.Request):
+    refused = refuse_bad_client(request)
+    if refused is not None:
+        return refused
+    try:
+        file_id, secure_hash, signature = parse_path(request)
+        _, _, file_info = await get_file_info(file_id, secure_hash, signature)
+        mime_type, file_name = get_mime_and_name(file_info)
+        return web.json_response(
+            {
+                "file_name": file_name,
+                "file_size": file_info.file_size,
+                "mime_type": mime_type,
+                "download_url": urllib.parse.urljoin(Var.URL, link_path(file_id, secure_hash, signature)),
+                "watch_url": urllib.parse.urljoin(Var.URL, "watch/" + link_path(file_id, secure_hash, signature)),
+            }
+        )
+
+    except InvalidHash as e:
+        bad_requests.failed(client_ip(request))
+        return web.HTTPForbidden(text=str(e))
+    except FIleNotFound as e:
+        bad_requests.failed(client_ip(request))
+        return web.HTTPNotFound(text=str(e))
+    except (AttributeError, BadStatusLine, ConnectionResetError) as e:
+        logger.warning(f"Ignored exception: {e}")
+        return web.Response(text="Temporary error occurred", status=503)
+    except Exception as e:
+        logger.exception("Unexpected error in meta_handler")
+        return web.HTTPInternalServerError(text=str(e))
+
+
+# ------------------------------
+# /admin/popular route
+# ------------------------------
+@routes.get("/admin/popular", allow_head=True)
+async def popular_handler(request: web.Request):
+    if not Var.ADMIN_TOKEN:
+        return web.HTTPNotFound()
+    if not is_admin(request):
+        return web.HTTPForbidden(text="Invalid token")
+    try:
+        n = min(int(request.query.get("n", "20")), 1000)
+    except ValueError:
+        return web.HTTPBadRequest(text="n must be a number")
+    return web.json_response(
+        {
+            "files": popularity.top(n),
+            "part_cache": part_cache.stats(),
+            "mirror": mirror.stats(),
+        }
+    )
+
+
 # ------------------------------
 # /{path} route for file streaming
 # ------------------------------
 @routes.get(r"/{path:\S+}", allow_head=True)
 async def file_handler(request: web.Request):
+    refused = refuse_bad_client(request)
+    if refused is not None:
+        return refused
+    trace = start_trace(f"{request.method} {request.path}")
     try:
-        path = request.match_info["path"]
-        match = re.search(r"^([a-zA-Z0-9_-]{6})(\d+)$", path)
-        if match:
-            secure_hash = match.group(1)
-            file_id = int(match.group(2))
-        else:
-            file_id = int(re.search(r"(\d+)(?:\/\S+)?", path).group(1))
-            secure_hash = request.rel_url.query.get("hash")
+        file_id, secure_hash, signature = parse_path(request)
 
-        return await media_streamer(request, file_id, secure_hash)
+        if request.method == "HEAD":
+            response = await media_head(request, file_id, secure_hash, signature)
+        else:
+            response = await media_streamer(request, file_id, secure_hash, signature)
+        if not response.prepared:
+            response.headers["Server-Timing"] = trace.server_timing()
+        return response
 
     except InvalidHash as e:
+        bad_requests.failed(client_ip(request))
         return web.HTTPForbidden(text=str(e))
     except FIleNotFound as e:
+        bad_requests.failed(client_ip(request))
         return web.HTTPNotFound(text=str(e))
+    except Overloaded as e:
+        return web.Response(
+            status=e.status, text=str(e), headers={"Retry-After": str(math.ceil(e.retry_after))}
+        )
     except (AttributeError, BadStatusLine, ConnectionResetError) as e:
         logger.warning(f"Ignored exception: {e}")
         return web.Response(text="Temporary error occurred", status=503)
     except Exception as e:
         logger.exception("Unexpected error in file_handler")
         return web.HTTPInternalServerError(text=str(e))
+    finally:
+        trace.finish()
 
 
 # ------------------------------
@@ -112,15 +270,8 @@ async def file_handler(request: web.Request):
 class_cache = {}
 
 
-async def media_streamer(request: web.Request, file_id: int, secure_hash: str):
-    range_header = request.headers.get("Range", None)
-
-    index = min(work_loads, key=work_loads.get)
+def get_streamer(index: int) -> ByteStreamer:
     faster_client = multi_clients[index]
-
-    if Var.MULTI_CLIENT:
-        logger.info(f"Client {index} is now serving {request.remote}")
-
     if faster_client in class_cache:
         tg_connect = class_cache[faster_client]
         logger.debug(f"Using cached ByteStreamer object for client {index}")
@@ -128,38 +279,30 @@ async def media_streamer(request: web.Request, file_id: int, secure_hash: str):
         tg_connect = ByteStreamer(faster_client)
         class_cache[faster_client] = tg_connect
         logger.debug(f"Created new ByteStreamer object for client {index}")
+    return tg_connect
+
+
+async def get_file_info(file_id: int, secure_hash: str, signature: Optional[str] = None):
+    """
+    Returns the chosen client index, its ByteStreamer and the checked properties of the file.
+    Only the metadata cache is used here, no file parts are requested.
+    The hash is not checked for links with a signature, parse_path verified it already.
+    """
+    # bots already serving CLIENT_STREAM_LIMIT streams are skipped unless every bot is full
+    index = scheduler.pick(admission.open_clients(multi_clients))
+    tg_connect = get_streamer(index)
 
     file_info = await tg_connect.get_file_properties(file_id)
 
-    if file_info.unique_id[:6] != secure_hash:
+    if not signature and file_info.unique_id[:6] != secure_hash:
         logger.debug(f"Invalid hash for message ID {file_id}")
         raise InvalidHash
+    return index, tg_connect, file_info
 
-    file_size = file_info.file_size
-
-    # Handle Range header safely
-    if range_header:
-        from_bytes, until_bytes = range_header.replace("bytes=", "").split("-")
-        from_bytes = int(from_bytes)
-        until_bytes = int(until_bytes) if until_bytes else file_size - 1
-    else:
-        from_bytes = 0
-        until_bytes = file_size - 1
-
-    req_length = until_bytes - from_bytes
-    new_chunk_size = await chunk_size(req_length)
-    offset = await offset_fix(from_bytes, new_chunk_size)
-    first_part_cut = from_bytes - offset
-    last_part_cut = (until_bytes % new_chunk_size) + 1
-    part_count = math.ceil(req_length / new_chunk_size)
-
-    body = tg_connect.yield_file(
-        file_info, index, offset, first_part_cut, last_part_cut, part_count, new_chunk_size
-    )
 
+def get_mime_and_name(file_info):
     mime_type = file_info.mime_type or "application/octet-stream"
     file_name = file_info.file_name or f"{secrets.token_hex(2)}.unknown"
-    disposition = "attachment"
 
     # Try to guess extension if missing
     if mime_type != "application/octet-stream" and "." not in file_name:
@@ -167,18 +310,297 @@ async def media_streamer(request: web.Request, file_id: int, secure_hash: str):
             file_name += f".{mime_type.split('/')[1]}"
         except Exception:
             pass
+    return mime_type, file_name
 
-    resp_headers = {
-        "Content-Type": mime_type,
-        "Range": f"bytes={from_bytes}-{until_bytes}",
-        "Content-Range": f"bytes {from_bytes}-{until_bytes}/{file_size}",
-        "Content-Disposition": f'{disposition}; filename="{file_name}"',
+
+def cache_control(signature: Optional[str]) -> str:
+    """
+    Returns MEDIA_CACHE_CONTROL, with the max-age of a link that expires cut to the time it has left
+    so shared caches don't keep serving it once it expired.
+    """
+    left = seconds_left(signature)
+    if left is None:
+        return Var.MEDIA_CACHE_CONTROL
+    return re.sub(
+        r"\b(s-maxage|max-age)=(\d+)",
+        lambda m: f"{m.group(1)}={min(int(m.group(2)), left)}",
+        Var.MEDIA_CACHE_CONTROL,
+    )
+
+
+def get_validators(file_info, signature: Optional[str] = None) -> dict:
+    """
+    Returns the caching headers of a file, the ETag is strong since the bytes of a
+    file_unique_id never change.
+    """
+    headers = {
+        "ETag": f'"{file_info.unique_id}"',
+        "Cache-Control": cache_control(signature),
+    }
+    date = getattr(file_info, "date", None)
+    if date:
+        headers["Last-Modified"] = email.utils.formatdate(date.timestamp(), usegmt=True)
+    return headers
+
+
+def is_not_modified(request: web.Request, validators: dict) -> bool:
+    if_none_match = request.headers.get("If-None-Match")
+    if if_none_match is not None:
+        etags = [tag.strip() for tag in if_none_match.split(",")]
+        # weak comparison as required for If-None-Match
+        return "*" in etags or validators["ETag"] in etags or f"W/{validators['ETag']}" in etags
+    if_modified_since = request.if_modified_since
+    if if_modified_since is not None and "Last-Modified" in validators:
+        last_modified = email.utils.parsedate_to_datetime(validators["Last-Modified"])
+        return last_modified <= if_modified_since
+    return False
+
+
+def is_range_valid(request: web.Request, validators: dict) -> bool:
+    """
+    Checks If-Range, a Range header must be ignored when the file changed since the client
+    stored the part it has.
+    """
+    if_range = request.headers.get("If-Range")
+    if if_range is None:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"'):
+        # strong comparison, weak tags never match
+        return if_range == validators["ETag"]
+    return if_range == validators.get("Last-Modified")
+
+
+def plan_response(request: web.Request, file_info, validators: dict):
+    """
+    Works out the status, the headers and the byte ranges of the answer to a file request.
+    returns the status, the headers, the list of inclusive (start, end) ranges to send and,
+    for multipart/byteranges answers, the part headers and the closing boundary.
+    """
+    file_size = file_info.file_size
+    mime_type, file_name = get_mime_and_name(file_info)
+    headers = {
+        "Content-Disposition": f'attachment; filename="{file_name}"',
         "Accept-Ranges": "bytes",
+        **validators,
     }
 
-    return_resp = web.Response(status=206 if range_header else 200, body=body, headers=resp_headers)
+    range_header = request.headers.get("Range", None)
+    if range_header and not is_range_valid(request, validators):
+        range_header = None
+    ranges = parse_range(range_header, file_size)
+
+    if ranges is None:
+        headers["Content-Type"] = mime_type
+        headers["Content-Length"] = str(file_size)
+        return 200, headers, [(0, file_size - 1)] if file_size else [], None
+
+    if not ranges:
+        headers["Content-Range"] = f"bytes */{file_size}"
+        return 416, headers, [], None
+
+    if len(ranges) == 1:
+        from_bytes, until_bytes = ranges[0]
+        headers["Content-Type"] = mime_type
+        headers["Content-Range"] = f"bytes {from_bytes}-{until_bytes}/{file_size}"
+        headers["Content-Length"] = str(until_bytes - from_bytes + 1)
+        return 206, headers, ranges, None
+
+    boundary = secrets.token_hex(16)
+    part_headers = multipart_headers(boundary, mime_type, ranges, file_size)
+    trailer = multipart_trailer(boundary)
+    length = sum(map(len, part_headers)) + sum(end - start + 1 for start, end in ranges) + len(trailer)
+    headers["Content-Type"] = f"multipart/byteranges; boundary={boundary}"
+    headers["Content-Length"] = str(length)
+    return 206, headers, ranges, (part_headers, trailer)
+
+
+async def media_head(request: web.Request, file_id: int, secure_hash: str, signature: Optional[str] = None):
+    _, _, file_info = await get_file_info(file_id, secure_hash, signature)
+    validators = get_validators(file_info, signature)
+    if is_not_modified(request, validators):
+        return web.Response(status=304, headers=validators)
+
+    status, headers, _, _ = plan_response(request, file_info, validators)
+    return web.Response(status=status, headers=headers)
+
+
+class MirrorResponse(web.FileResponse):
+    def __init__(self, fobj, offset: int, count: int, status: int, headers: dict, flow: Optional[Flow] = None):
+        """Sends a range of a mirrored file with sendfile, the status, headers and range
+        are already worked out by plan_response so they match the ones of a Telegram stream.
+        With a bandwidth flow the range is sent a part at a time, each part once it is granted.
+        """
+        super().__init__(fobj.name, status=status, headers=headers)
+        self._fobj = fobj
+        self._offset = offset
+        self._count = count
+        self._flow = flow
+
+    async def prepare(self, request: web.BaseRequest):
+        try:
+            if self._flow is None:
+                return await self._sendfile(request, self._fobj, self._offset, self._count)
+            return await self._sendfile_granted(request)
+        finally:
+            bandwidth.close(self._flow)
+            await asyncio.get_running_loop().run_in_executor(None, self._fobj.close)
 
-    if return_resp.status == 200:
-        return_resp.headers.add("Content-Length", str(file_size))
+    async def _sendfile_granted(self, request: web.BaseRequest):
+        writer = await web.StreamResponse.prepare(self, request)
+        loop = asyncio.get_running_loop()
+        # like FileResponse._sendfile, chunks go through the writer when sendfile can't be used
+        use_sendfile = not (NOSENDFILE or self.compression)
+        offset, end = self._offset, self._offset + self._count
+        while offset < end:
+            count = min(PART_SIZE, end - offset)
+            await bandwidth.acquire(self._flow, count)
+            if use_sendfile:
+                try:
+                    await loop.sendfile(request.transport, self._fobj, offset, count)
+                except NotImplementedError:
+                    use_sendfile = False
+            if not use_sendfile:
+                await self._sendfile_fallback(writer, self._fobj, offset, count)
+            offset += count
+        await web.StreamResponse.write_eof(self)
+        return writer
 
-    return return_resp
+
+def buffered_size(ranges) -> int:
+    """
+    Returns the bytes a stream may hold at once, the parts read ahead and the write buffer.
+    """
+    length = sum(end - start + 1 for start, end in ranges)
+    return min(length, Var.PARALLEL_PARTS * MAX_PART_SIZE + Var.WRITE_BUFFER)
+
+
+def stream_priority(status: int, ranges, multipart) -> str:
+    """
+    Returns the bandwidth priority of a stream. Short single ranges are what players ask for,
+    everything else, like full downloads and the large ranges of download accelerators, is bulk.
+    """
+    if status == 206 and not multipart and ranges[0][1] - ranges[0][0] < Var.PLAYBACK_RANGE * 2 ** 20:
+        return "playback"
+    return "bulk"
+
+
+async def range_body(tg_connect: ByteStreamer, file_info, index: int, ranges, multipart):
+    """
+    Yields the bytes of every range from one generator, with the multipart boundaries if needed.
+    """
+    for i, (from_bytes, until_bytes) in enumerate(ranges):
+        if multipart:
+            yield multipart[0][i]
+
+        # CDN parts are verified by whole hash blocks, smaller parts would download a block anyway
+        min_size = CdnFile.HASH_BLOCK if cdn_files.get(file_info.media_id) else MIN_PART_SIZE
+        new_chunk_size = dc_stats.part_size(file_info.dc_id, from_bytes, until_bytes, min_size)
+        offset = await offset_fix(from_bytes, new_chunk_size)
+        first_part_cut = from_bytes - offset
+        last_part_cut = (until_bytes % new_chunk_size) + 1
+        part_count = until_bytes // new_chunk_size - offset // new_chunk_size + 1
+
+        async with aclosing(tg_connect.yield_file(
+            file_info, index, offset, first_part_cut, last_part_cut, part_count, new_chunk_size
+        )) as body:
+            async for chunk in body:
+                yield chunk
+
+    if multipart:
+        yield multipart[1]
+
+
+async def media_streamer(request: web.Request, file_id: int, secure_hash: str, signature: Optional[str] = None):
+    ip = client_ip(request)
+    index, tg_connect, file_info = await get_file_info(file_id, secure_hash, signature)
+    popularity.record(ip, file_info.media_id, file_id)
+
+    validators = get_validators(file_info, signature)
+    if is_not_modified(request, validators):
+        return web.Response(status=304, headers=validators)
+
+    status, resp_headers, ranges, multipart = plan_response(request, file_info, validators)
+    if not ranges:
+        return web.Response(status=status, headers=resp_headers)
+
+    if Var.MULTI_CLIENT:
+        logger.info(f"Client {index} is now serving {ip}")
+    priority = stream_priority(status, ranges, multipart)
+
+    if not multipart:
+        fobj = await mirror.open(file_info.media_id, file_info.file_size)
+        if fobj is not None:
+            from_bytes, until_bytes = ranges[0]
+            popularity.hit(file_info.media_id, until_bytes // PART_SIZE - from_bytes // PART_SIZE + 1)
+            sent_bytes.labels("mirror").inc(until_bytes - from_bytes + 1)
+            flow = bandwidth.open(ip, file_id, priority)
+            return MirrorResponse(fobj, from_bytes, until_bytes - from_bytes + 1, status, resp_headers, flow)
+
+    # streams over the limits wait here, or are refused with an Overloaded
+    ticket = await admission.acquire(ip, index, buffered_size(ranges))
+    sent = 0
+    served = sent_bytes.labels(f"bot{index + 1}")
+    flow = bandwidth.open(ip, file_id, priority)
+    try:
+        if not multipart:
+            mirror.request(
+                file_info.media_id,
+                file_info.file_size,
+                lambda offset: tg_connect.get_part(index, file_info, offset, PART_SIZE, store=False),
+            )
+
+            # players read a file as back to back ranges, get the next parts ready before they are asked for
+            prefetcher.start(
+                ip,
+                file_info.media_id,
+                ranges[0][0],
+                ranges[0][1],
+                file_info.file_size,
+                lambda offset: tg_connect.get_part(index, file_info, offset, PART_SIZE),
+                lambda offset: (file_info.media_id, offset) in part_cache,
+            )
+
+        async with aclosing(range_body(tg_connect, file_info, index, ranges, multipart)) as body:
+            # the headers wait for the first part, so a failing file still gets an error status
+            # and Server-Timing covers everything the viewer waited for
+            with span("first_part"):
+                chunk = await anext(body)
+            trace = current_trace.get()
+            if trace is not None:
+                trace.mark_first_byte()
+                resp_headers["Server-Timing"] = trace.server_timing()
+
+            resp = web.StreamResponse(status=status, headers=resp_headers)
+            await resp.prepare(request)
+            transport = request.transport
+            if transport is not None:
+                # writes wait for the viewer to read once this much is buffered
+                transport.set_write_buffer_limits(high=Var.WRITE_BUFFER, low=Var.WRITE_BUFFER // 4)
+
+            try:
+                while chunk is not None:
+                    if transport is None or transport.is_closing():
+                        raise ConnectionResetError("Viewer disconnected")
+                    await bandwidth.acquire(flow, len(chunk))
+                    await resp.write(chunk)
+                    sent += len(chunk)
+                    served.inc(len(chunk))
+                    chunk = await anext(body, None)
+            except ConnectionResetError:
+                # closing the body cancels the parts that are still being fetched
+                wasted_bytes.inc(len(chunk))
+                logger.debug(f"{ip} disconnected after {sent} bytes")
+            except Exception:
+                logger.exception(f"Stream of message ID {file_id} failed after {sent} bytes")
+    finally:
+        bandwidth.close(flow)
+        admission.release(ticket)
+
+    if sent != int(resp_headers["Content-Length"]):
+        # the body is cut short, the connection can't be reused
+        prefetcher.stop(ip, file_info.media_id)
+        resp.force_close()
+    else:
+        await resp.write_eof()
+    return resp
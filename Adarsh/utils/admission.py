@@ -0,0 +1,179 @@
+# (c) adarsh-goel
+import asyncio
+from collections import deque
+from typing import Deque, Dict, Hashable, Iterable, List, Optional, Tuple
+from Adarsh.vars import Var
+from Adarsh.server.exceptions import Overloaded
+
+
+class Ticket:
+    __slots__ = ("key", "client", "cost")
+
+    def __init__(self, key: Hashable, client: int, cost: int):
+        self.key = key
+        self.client = client
+        self.cost = cost
+
+
+class AdmissionControl:
+    def __init__(
+        self,
+        max_streams: int,
+        max_per_client: int,
+        max_per_key: int,
+        buffer_budget: int,
+        queue_size: int,
+        queue_timeout: float,
+    ):
+        """Limits the streams served at once, so a spike is turned away instead of making every viewer slower.
+        A stream is let in while it fits in the global limit, the limit of the bot serving it, the limit
+        of its viewer and the budget of buffered bytes. Otherwise it waits in a short FIFO queue for
+        queue_timeout seconds at most, a stream waiting for a full bot does not hold back the others.
+        A viewer over its own limit is refused with a 429 at once, without taking a place in the
+        queue, and a stream that finds the queue full or waits too long is refused with a 503.
+        attributes:
+            max_streams: streams served at once, 0 for no limit.
+            max_per_client: streams served at once by one bot client, 0 for no limit.
+            max_per_key: streams served or queued at once for one viewer, 0 for no limit.
+            buffer_budget: bytes the admitted streams may buffer together, 0 for no limit.
+            active: the streams being served.
+            buffered: the bytes reserved by the streams being served.
+            rejected: the refused streams by reason.
+        """
+        self.max_streams = max_streams
+        self.max_per_client = max_per_client
+        self.max_per_key = max_per_key
+        self.buffer_budget = buffer_budget
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.buffered = 0
+        self.admitted = 0
+        self.rejected: Dict[str, int] = {"viewer_limit": 0, "queue_full": 0, "queue_timeout": 0}
+        self._per_key: Dict[Hashable, int] = {}
+        self.clients: Dict[int, int] = {}
+        self._queue: Deque[Tuple[Ticket, asyncio.Future]] = deque()
+
+    @property
+    def queued(self) -> int:
+        return len(self._queue)
+
+    def _fits(self, cost: int) -> bool:
+        if self.max_streams and self.active >= self.max_streams:
+            return False
+        # a stream is always let in on an idle server, even if it costs more than the whole budget
+        return not self.buffer_budget or not self.active or self.buffered + cost <= self.buffer_budget
+
+    def client_full(self, client: int) -> bool:
+        return bool(self.max_per_client) and self.clients.get(client, 0) >= self.max_per_client
+
+    def open_clients(self, clients: Iterable[int]) -> List[int]:
+        """
+        Returns the bot clients that can take another stream, or all of them when every one is full.
+        """
+        clients = list(clients)
+        return [i for i in clients if not self.client_full(i)] or clients
+
+    def _start(self, ticket: Ticket) -> None:
+        self.active += 1
+        self.buffered += ticket.cost
+        self.clients[ticket.client] = self.clients.get(ticket.client, 0) + 1
+        self.admitted += 1
+
+    def _forget(self, key: Hashable) -> None:
+        left = self._per_key[key] - 1
+        if left:
+            self._per_key[key] = left
+        else:
+            del self._per_key[key]
+
+    def _refuse(self, reason: str, status: int) -> Overloaded:
+        self.rejected[reason] += 1
+        return Overloaded(status, self.queue_timeout or 1)
+
+    async def acquire(self, key: Hashable, client: int, cost: int) -> Ticket:
+        """
+        Waits for the stream of the viewer, served by the bot client, to be let in and returns its
+        ticket, to give back to release. Raises Overloaded when it is refused.
+        """
+        # the queued streams of a viewer count too, or a download accelerator could fill the queue
+        streams = self._per_key.get(key, 0)
+        if self.max_per_key and streams >= self.max_per_key:
+            raise self._refuse("viewer_limit", 429)
+        ticket = Ticket(key, client, cost)
+        ahead = any(not self.client_full(queued.client) for queued, _ in self._queue)
+        if not ahead and self._fits(cost) and not self.client_full(client):
+            self._per_key[key] = streams + 1
+            self._start(ticket)
+            return ticket
+        if len(self._queue) >= self.queue_size:
+            raise self._refuse("queue_full", 503)
+        self._per_key[key] = streams + 1
+
+        waiter = asyncio.get_running_loop().create_future()
+        entry = (ticket, waiter)
+        self._queue.append(entry)
+        timer = asyncio.get_running_loop().call_later(self.queue_timeout, self._expire, entry)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            # the viewer went away while waiting
+            if waiter.cancelled():
+                if entry in self._queue:
+                    self._queue.remove(entry)
+                self._forget(key)
+            elif waiter.exception() is None:
+                # it was let in at the same time, give the place back
+                self.release(ticket)
+            raise
+        finally:
+            timer.cancel()
+        return ticket
+
+    def _expire(self, entry: Tuple[Ticket, asyncio.Future]) -> None:
+        if entry[1].done():
+            return
+        self._queue.remove(entry)
+        self._forget(entry[0].key)
+        entry[1].set_exception(self._refuse("queue_timeout", 503))
+
+    def release(self, ticket: Optional[Ticket]) -> None:
+        if ticket is None:
+            return
+        self.active -= 1
+        self.buffered -= ticket.cost
+        self.clients[ticket.client] -= 1
+        self._forget(ticket.key)
+        # first come first served, only streams waiting for a full bot are overtaken
+        kept: Deque[Tuple[Ticket, asyncio.Future]] = deque()
+        while self._queue and self._fits(self._queue[0][0].cost):
+            ticket, waiter = entry = self._queue.popleft()
+            if waiter.done():
+                continue
+            if self.client_full(ticket.client):
+                kept.append(entry)
+                continue
+            self._start(ticket)
+            waiter.set_result(None)
+        kept.extend(self._queue)
+        self._queue = kept
+
+    def stats(self) -> dict:
+        return {
+            "active": self.active,
+            "queued": self.queued,
+            "buffered_bytes": self.buffered,
+            "clients": dict((f"bot{i + 1}", n) for i, n in sorted(self.clients.items())),
+            "admitted": self.admitted,
+            "rejected": dict(self.rejected),
+        }
+
+
+admission = AdmissionControl(
+    Var.STREAM_LIMIT,
+    Var.CLIENT_STREAM_LIMIT,
+    Var.IP_STREAM_LIMIT,
+    Var.BUFFER_BUDGET * 2 ** 20,
+    Var.QUEUE_SIZE,
+    Var.QUEUE_TIMEOUT,
+)
@@ -0,0 +1,224 @@
+# (c) adarsh-goel
+import time
+import asyncio
+from collections import OrderedDict
+from typing import Dict, Hashable, List, Optional, Tuple
+from Adarsh.vars import Var
+from .metrics import bandwidth_granted_bytes, bandwidth_throttled_seconds
+
+PRIORITIES = ("playback", "bulk")
+# seconds of traffic a bucket holds, what an idle viewer may send at once
+BURST = 1.0
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated", "flows")
+
+    def __init__(self, rate: float, now: float):
+        """Bytes a key may send, refilled at rate bytes a second. A grant may take more than is
+        left, the debt is paid back before the next one, so whole parts are let through at once.
+        attributes:
+            rate: bytes per second, 0 for no limit.
+            tokens: bytes left, negative while in debt.
+            flows: the open flows sharing the bucket.
+        """
+        self.rate = rate
+        self.burst = rate * BURST
+        self.tokens = self.burst
+        self.updated = now
+        self.flows = 0
+
+    def refill(self, now: float) -> None:
+        if self.rate:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def ready(self) -> bool:
+        return not self.rate or self.tokens >= 0
+
+    def take(self, length: int) -> None:
+        if self.rate:
+            self.tokens -= length
+
+    def wait(self) -> float:
+        """
+        Returns the seconds until the debt of the bucket is paid back.
+        """
+        if not self.rate or self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+
+class Flow:
+    __slots__ = ("ip", "link", "priority", "weight", "finish")
+
+    def __init__(self, ip: TokenBucket, link: TokenBucket, priority: str, weight: float):
+        """One response going through the scheduler.
+        attributes:
+            ip, link: the buckets of the viewer's IP and of the link.
+            priority: a name of PRIORITIES.
+            weight: the weight of the priority, shared by the open flows of the IP.
+            finish: the virtual time at which the bytes granted so far are served.
+        """
+        self.ip = ip
+        self.link = link
+        self.priority = priority
+        self.weight = weight
+        self.finish = 0.0
+
+
+class BandwidthScheduler:
+    def __init__(
+        self,
+        total_rate: float,
+        ip_rate: float,
+        link_rate: float,
+        playback_weight: float,
+        max_tracked: int = 100000,
+    ):
+        """Shares the egress between streams with a global, a per-IP and a per-link token bucket.
+        Bytes are granted before they are written. A grant is immediate while the buckets have
+        tokens. Otherwise the stream waits in a queue served by start-time fair queuing: the flows
+        of an IP share one weight, so sixteen connections get no more than one, and playback
+        flows weigh more than bulk downloads. One timer wakes the queue when tokens are back,
+        so no stream sleeps per chunk.
+        attributes:
+            total_rate, ip_rate, link_rate: bytes per second, 0 for no limit. With no limit at all
+                the scheduler is off and open returns None.
+            weights: the weight of every priority.
+            flows: the open flows by priority.
+        """
+        self.enabled = bool(total_rate or ip_rate or link_rate)
+        self.ip_rate = ip_rate
+        self.link_rate = link_rate
+        self.max_tracked = max_tracked
+        self.weights = {"playback": max(playback_weight, 1.0), "bulk": 1.0}
+        self.total = TokenBucket(total_rate, time.monotonic())
+        self.flows: Dict[str, int] = dict.fromkeys(PRIORITIES, 0)
+        self.vtime = 0.0
+        self._ips: "OrderedDict[Hashable, TokenBucket]" = OrderedDict()
+        self._links: "OrderedDict[Hashable, TokenBucket]" = OrderedDict()
+        # virtual start time, flow, bytes and the future the stream waits on
+        self._waiters: List[Tuple[float, Flow, int, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._granted = dict((p, bandwidth_granted_bytes.labels(p)) for p in PRIORITIES)
+        self._throttled = dict((p, bandwidth_throttled_seconds.labels(p)) for p in PRIORITIES)
+
+    def _bucket(self, buckets: "OrderedDict[Hashable, TokenBucket]", key: Hashable, rate: float) -> TokenBucket:
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = TokenBucket(rate, time.monotonic())
+            while len(buckets) > self.max_tracked:
+                buckets.popitem(last=False)
+        buckets.move_to_end(key)
+        return bucket
+
+    def open(self, ip: Hashable, link: Hashable, priority: str) -> Optional[Flow]:
+        """
+        Returns the flow of a new response, to give to acquire and close, or None when the scheduler is off.
+        """
+        if not self.enabled:
+            return None
+        flow = Flow(
+            self._bucket(self._ips, ip, self.ip_rate),
+            self._bucket(self._links, link, self.link_rate),
+            priority,
+            self.weights[priority],
+        )
+        flow.ip.flows += 1
+        flow.link.flows += 1
+        flow.finish = self.vtime
+        self.flows[priority] += 1
+        return flow
+
+    def close(self, flow: Optional[Flow]) -> None:
+        if flow is None:
+            return
+        flow.ip.flows -= 1
+        flow.link.flows -= 1
+        self.flows[flow.priority] -= 1
+
+    def _ready(self, flow: Flow, now: float) -> bool:
+        for bucket in (self.total, flow.ip, flow.link):
+            bucket.refill(now)
+        return self.total.ready() and flow.ip.ready() and flow.link.ready()
+
+    def _grant(self, flow: Flow, length: int, start: float) -> None:
+        for bucket in (self.total, flow.ip, flow.link):
+            bucket.take(length)
+        self.vtime = max(self.vtime, start)
+        self._granted[flow.priority].inc(length)
+
+    async def acquire(self, flow: Optional[Flow], length: int) -> None:
+        """
+        Waits until length bytes of the flow may be sent, returns at once while there are tokens.
+        """
+        if flow is None:
+            return
+        start = max(self.vtime, flow.finish)
+        flow.finish = start + length * max(flow.ip.flows, 1) / flow.weight
+        now = time.monotonic()
+        if not self._waiters and self._ready(flow, now):
+            self._grant(flow, length, start)
+            return
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append((start, flow, length, waiter))
+        self._dispatch()
+        try:
+            # a cancelled waiter stays in the queue until the next dispatch drops it
+            await waiter
+        finally:
+            self._throttled[flow.priority].inc(time.monotonic() - now)
+
+    def _dispatch(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        now = time.monotonic()
+        self._waiters.sort(key=lambda waiter: waiter[0])
+        blocked = []
+        wake = None
+        for start, flow, length, waiter in self._waiters:
+            if waiter.done():
+                continue
+            if self._ready(flow, now):
+                self._grant(flow, length, start)
+                waiter.set_result(None)
+                continue
+            # a viewer over its own limit does not hold back the others
+            blocked.append((start, flow, length, waiter))
+            delay = max(self.total.wait(), flow.ip.wait(), flow.link.wait())
+            wake = delay if wake is None else min(wake, delay)
+        self._waiters = blocked
+        if wake is not None:
+            self._timer = asyncio.get_running_loop().call_later(max(wake, 0.001), self._dispatch)
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    def allocations(self) -> Dict[str, float]:
+        """
+        Returns the global limit split between the priorities by the weights of their open flows.
+        """
+        if not self.total.rate:
+            return {}
+        shares = dict((p, self.flows[p] * self.weights[p]) for p in PRIORITIES)
+        total = sum(shares.values())
+        return dict((p, self.total.rate * share / total if total else 0.0) for p, share in shares.items())
+
+    def stats(self) -> dict:
+        return {
+            "flows": dict(self.flows),
+            "waiting": self.waiting,
+            "allocations": dict((p, round(rate)) for p, rate in self.allocations().items()),
+        }
+
+
+bandwidth = BandwidthScheduler(
+    Var.BANDWIDTH_LIMIT * 2 ** 20,
+    Var.IP_BANDWIDTH * 2 ** 20,
+    Var.LINK_BANDWIDTH * 2 ** 20,
+    Var.PLAYBACK_WEIGHT,
+)
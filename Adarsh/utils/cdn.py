@@ -0,0 +1,116 @@
+# (c) adarsh-goel
+import asyncio
+from hashlib import sha256
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional
+from pyrogram import raw
+from pyrogram.crypto import aes
+from pyrogram.errors import CDNFileHashMismatch
+
+
+# whether GetFile tells Telegram that files may be redirected to a CDN DC. pyrogram can't connect to
+# CDN DCs yet: they are missing from its DataCenter table and their RSA keys, which come from
+# help.getCdnConfig, are not loaded, so files are only downloaded from their own DC for now
+OFFER_CDN = False
+
+
+class CdnUnavailable(Exception):
+    message = "The file could not be fetched from the Telegram CDN"
+
+
+class CdnFile:
+    # size of the blocks covered by one CDN file hash
+    HASH_BLOCK = 128 * 1024
+
+    def __init__(self, redirect: raw.types.upload.FileCdnRedirect):
+        """The state needed to download one file from a Telegram CDN DC.
+        attributes:
+            dc_id: the CDN DC that holds the file.
+            file_token: the token to use with upload.GetCdnFile.
+            hashes: a dict of known sha256 hashes by block offset, used to verify the parts.
+        """
+        self.dc_id = redirect.dc_id
+        self.file_token = redirect.file_token
+        self.encryption_key = redirect.encryption_key
+        self.encryption_iv = redirect.encryption_iv
+        self.hashes: Dict[int, bytes] = {}
+        self.add_hashes(redirect.file_hashes)
+
+    def add_hashes(self, hashes: Iterable[raw.types.FileHash]) -> int:
+        """
+        Stores the hashes and returns how many were not known yet.
+        """
+        added = 0
+        for h in hashes:
+            if h.offset not in self.hashes:
+                added += 1
+            self.hashes[h.offset] = h.hash
+        return added
+
+    def missing_hash(self, offset: int, length: int) -> Optional[int]:
+        """
+        Returns the offset of the first block of the part whose hash is not known yet.
+        """
+        for block in range(offset - offset % self.HASH_BLOCK, offset + length, self.HASH_BLOCK):
+            if block not in self.hashes:
+                return block
+        return None
+
+    async def decrypt(self, data: bytes, offset: int) -> bytes:
+        # https://core.telegram.org/cdn#decrypting-files
+        iv = bytearray(self.encryption_iv[:-4] + (offset // 16).to_bytes(4, "big"))
+        # on the default executor, pyrogram's crypto executor has a single thread that every MTProto
+        # packet of every session goes through
+        return await asyncio.get_running_loop().run_in_executor(
+            None, aes.ctr256_decrypt, data, self.encryption_key, iv
+        )
+
+    def verify(self, data: bytes, offset: int) -> None:
+        # https://core.telegram.org/cdn#verifying-files
+        # only whole blocks can be checked, data must start on a block
+        view = memoryview(data)
+        for start in range(0, len(data), self.HASH_BLOCK):
+            block = view[start:start + self.HASH_BLOCK]
+            CDNFileHashMismatch.check(self.hashes.get(offset + start) == sha256(block).digest())
+
+
+class CdnFiles:
+    def __init__(self, max_entries: int = 1000):
+        """The files Telegram redirected to a CDN DC, by media ID, and the files whose CDN download
+        failed, which are not offered to the CDN again.
+        """
+        self.max_entries = max_entries
+        self._files: "OrderedDict[int, CdnFile]" = OrderedDict()
+        self._failed: "OrderedDict[int, None]" = OrderedDict()
+
+    def get(self, media_id: int) -> Optional[CdnFile]:
+        cdn_file = self._files.get(media_id)
+        if cdn_file is not None:
+            self._files.move_to_end(media_id)
+        return cdn_file
+
+    def add(self, media_id: int, redirect: raw.types.upload.FileCdnRedirect) -> CdnFile:
+        cdn_file = self._files[media_id] = CdnFile(redirect)
+        self._files.move_to_end(media_id)
+        while len(self._files) > self.max_entries:
+            self._files.popitem(last=False)
+        return cdn_file
+
+    def pop(self, media_id: int) -> None:
+        self._files.pop(media_id, None)
+
+    def fail(self, media_id: int) -> None:
+        self._files.pop(media_id, None)
+        self._failed[media_id] = None
+        self._failed.move_to_end(media_id)
+        while len(self._failed) > self.max_entries:
+            self._failed.popitem(last=False)
+
+    def failed(self, media_id: int) -> bool:
+        return media_id in self._failed
+
+    def __len__(self) -> int:
+        return len(self._files)
+
+
+cdn_files = CdnFiles()
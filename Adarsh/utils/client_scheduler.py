@@ -0,0 +1,107 @@
+# (c) adarsh-goel
+import time
+from typing import Callable, Dict, Iterable
+
+
+class ClientStats:
+    __slots__ = ("streams", "bytes_in_flight", "latency", "error_rate", "requests", "flood_until")
+
+    def __init__(self):
+        self.streams = 0
+        self.bytes_in_flight = 0
+        self.latency = 0.1  # seconds, optimistic guess until the first GetFile returns
+        self.error_rate = 0.0
+        self.requests = 0
+        self.flood_until = 0.0
+
+    def as_dict(self, now: float) -> dict:
+        return {
+            "streams": self.streams,
+            "bytes_in_flight": self.bytes_in_flight,
+            "latency_ms": round(self.latency * 1000, 1),
+            "error_rate": round(self.error_rate, 3),
+            "requests": self.requests,
+            "flood_wait": max(round(self.flood_until - now), 0),
+        }
+
+
+def least_loaded(stats: ClientStats) -> float:
+    return stats.streams
+
+
+def adaptive(stats: ClientStats) -> float:
+    # rough time for the client to get through the bytes it already has to serve
+    return (1 + stats.bytes_in_flight / 2 ** 20) * stats.latency * (1 + 4 * stats.error_rate)
+
+
+STRATEGIES: Dict[str, Callable[[ClientStats], float]] = {
+    "adaptive": adaptive,
+    "least_loaded": least_loaded,
+}
+
+
+class ClientScheduler:
+    # weight of the newest sample in the moving averages
+    ALPHA = 0.2
+
+    def __init__(self, strategy: str = "adaptive"):
+        """Chooses the client that serves a stream from what the clients are doing.
+        attributes:
+            strategy: name of the scoring function in STRATEGIES, the lowest score is picked.
+            stats: a dict of ClientStats by client index.
+        """
+        self.strategy = strategy if strategy in STRATEGIES else "adaptive"
+        self.score = STRATEGIES[self.strategy]
+        self.stats: Dict[int, ClientStats] = {}
+
+    def _get(self, index: int) -> ClientStats:
+        stats = self.stats.get(index)
+        if stats is None:
+            stats = self.stats[index] = ClientStats()
+        return stats
+
+    def pick(self, clients: Iterable[int]) -> int:
+        """
+        Returns the index of the client that should serve the next stream.
+        Clients in a FloodWait are skipped unless every client is waiting.
+        """
+        now = time.monotonic()
+        indexes = list(clients)
+        ready = [i for i in indexes if self._get(i).flood_until <= now]
+        if not ready:
+            ready = [min(indexes, key=lambda i: self.stats[i].flood_until)]
+        return min(ready, key=lambda i: self.score(self.stats[i]))
+
+    def start(self, index: int, length: int) -> None:
+        stats = self._get(index)
+        stats.streams += 1
+        stats.bytes_in_flight += length
+
+    def sent(self, index: int, length: int) -> None:
+        self._get(index).bytes_in_flight -= length
+
+    def finish(self, index: int, remaining: int) -> None:
+        stats = self._get(index)
+        stats.streams -= 1
+        stats.bytes_in_flight -= remaining
+
+    def record(self, index: int, latency: float, ok: bool = True) -> None:
+        stats = self._get(index)
+        stats.requests += 1
+        if ok:
+            stats.latency += self.ALPHA * (latency - stats.latency)
+        stats.error_rate += self.ALPHA * ((0.0 if ok else 1.0) - stats.error_rate)
+
+    def flood_wait(self, index: int, seconds: float) -> None:
+        stats = self._get(index)
+        stats.flood_until = max(stats.flood_until, time.monotonic() + seconds)
+        self.record(index, 0, ok=False)
+
+    def snapshot(self) -> dict:
+        now = time.monotonic()
+        return {
+            "strategy": self.strategy,
+            "clients": dict(
+                ("bot" + str(i + 1), s.as_dict(now)) for i, s in sorted(self.stats.items())
+            ),
+        }
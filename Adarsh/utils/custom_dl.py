@@ -1,19 +1,35 @@
-import math
+import time
 import asyncio
 import logging
+from collections import deque
 from Adarsh.vars import Var
-from typing import Dict, Union
-from Adarsh.bot import work_loads
+from typing import Optional, Union
+from Adarsh.bot import work_loads, multi_clients, scheduler
 from pyrogram import Client, utils, raw
 from .file_properties import get_file_ids
-from pyrogram.session import Session, Auth
-from pyrogram.errors import AuthBytesInvalid
+from .part_cache import part_cache
+from .popularity import popularity
+from .file_cache import file_cache
+from .inflight import InflightTable
+from .session_pool import MediaSessionPool, media_sessions, cdn_sessions
+from .cdn import CdnFile, CdnUnavailable, cdn_files, OFFER_CDN
+from .metrics import wasted_bytes, get_file_seconds, flood_waits, flood_wait_seconds
+from .dc_stats import dc_stats, MAX_PART_SIZE
+from .tracing import span
+from pyrogram.errors import (
+    FloodWait, BadRequest, CDNFileHashMismatch, FileReferenceExpired, FileReferenceInvalid,
+    InternalServerError, ServiceUnavailable
+)
 from Adarsh.server.exceptions import FIleNotFound
 from pyrogram.file_id import FileId, FileType, ThumbnailSource
 
 
-async def chunk_size(length):
-    return 2 ** max(min(math.ceil(math.log2(length / 1024)), 10), 2) * 1024
+# every bulk stream is split into parts of the same size so that parts downloaded
+# for one request line up with the parts needed by any other request
+PART_SIZE = MAX_PART_SIZE
+
+# GetFile requests currently running, shared by every ByteStreamer
+inflight_parts = InflightTable()
 
 
 async def offset_fix(offset, chunksize):
@@ -23,24 +39,20 @@ async def offset_fix(offset, chunksize):
 
 class ByteStreamer:
     def __init__(self, client: Client):
-        """A custom class that holds the cache of a specific client and class functions.
+        """A custom class that holds a specific client and class functions.
         attributes:
-            client: the client that the cache is for.
-            cached_file_ids: a dict of cached file IDs.
-            cached_file_properties: a dict of cached file properties.
+            client: the client that the streamer is for.
         
+        File properties are kept in the process wide file_cache shared by every client.
+
         functions:
             generate_file_properties: returns the properties for a media of a specific message contained in Tuple.
-            generate_media_session: returns the media session for the DC that contains the media file.
             yield_file: yield a file from telegram servers for streaming.
             
         This is a modified version of the <https://github.com/eyaadh/megadlbot_oss/blob/master/mega/telegram/utils/custom_download.py>
         Thanks to Eyaadh <https://github.com/eyaadh>
         """
-        self.clean_timer = 30 * 60
         self.client: Client = client
-        self.cached_file_ids: Dict[int, FileId] = {}
-        asyncio.create_task(self.clean_cache())
 
     async def get_file_properties(self, id: int) -> FileId:
         """
@@ -48,10 +60,8 @@ class ByteStreamer:
         if the properties are cached, then it'll return the cached results.
         or it'll generate the properties from the Message ID and cache them.
         """
-        if id not in self.cached_file_ids:
-            await self.generate_file_properties(id)
-            logging.debug(f"Cached file properties for message with ID {id}")
-        return self.cached_file_ids[id]
+        with span("meta"):
+            return await file_cache.get_or_load(id, lambda: self.generate_file_properties(id))
     
     async def generate_file_properties(self, id: int) -> FileId:
         """
@@ -63,66 +73,7 @@ class ByteStreamer:
         if not file_id:
             logging.debug(f"Message with ID {id} not found")
             raise FIleNotFound
-        self.cached_file_ids[id] = file_id
-        logging.debug(f"Cached media message with ID {id}")
-        return self.cached_file_ids[id]
-
-    async def generate_media_session(self, client: Client, file_id: FileId) -> Session:
-        """
-        Generates the media session for the DC that contains the media file.
-        This is required for getting the bytes from Telegram servers.
-        """
-
-        media_session = client.media_sessions.get(file_id.dc_id, None)
-
-        if media_session is None:
-            if file_id.dc_id != await client.storage.dc_id():
-                media_session = Session(
-                    client,
-                    file_id.dc_id,
-                    await Auth(
-                        client, file_id.dc_id, await client.storage.test_mode()
-                    ).create(),
-                    await client.storage.test_mode(),
-                    is_media=True,
-                )
-                await media_session.start()
-
-                for _ in range(6):
-                    exported_auth = await client.invoke(
-                        raw.functions.auth.ExportAuthorization(dc_id=file_id.dc_id)
-                    )
-
-                    try:
-                        await media_session.send(
-                            raw.functions.auth.ImportAuthorization(
-                                id=exported_auth.id, bytes=exported_auth.bytes
-                            )
-                        )
-                        break
-                    except AuthBytesInvalid:
-                        logging.debug(
-                            f"Invalid authorization bytes for DC {file_id.dc_id}"
-                        )
-                        continue
-                else:
-                    await media_session.stop()
-                    raise AuthBytesInvalid
-            else:
-                media_session = Session(
-                    client,
-                    file_id.dc_id,
-                    await client.storage.auth_key(),
-                    await client.storage.test_mode(),
-                    is_media=True,
-                )
-                await media_session.start()
-            logging.debug(f"Created media session for DC {file_id.dc_id}")
-            client.media_sessions[file_id.dc_id] = media_session
-        else:
-            logging.debug(f"Using cached media session for DC {file_id.dc_id}")
-        return media_session
-
+        return file_id
 
     @staticmethod
     async def get_location(file_id: FileId) -> Union[raw.types.InputPhotoFileLocation,
@@ -184,54 +135,287 @@ class ByteStreamer:
         Modded from <https://github.com/eyaadh/megadlbot_oss/blob/master/mega/telegram/utils/custom_download.py#L20>
         Thanks to Eyaadh <https://github.com/eyaadh>
         """
-        client = self.client
         work_loads[index] += 1
+        remaining = (part_count - 1) * chunk_size + last_part_cut - first_part_cut
+        scheduler.start(index, remaining)
+        dc_stats.seen(file_id.dc_id, index, file_id)
         logging.debug(f"Starting to yielding file with client {index}.")
-        media_session = await self.generate_media_session(client, file_id)
 
         current_part = 1
-
-        location = await self.get_location(file_id)
+        scheduled_parts = 0
+        pending = deque()
 
         try:
-            r = await media_session.send(
-                raw.functions.upload.GetFile(
-                    location=location, offset=offset, limit=chunk_size
-                ),
-            )
-            if isinstance(r, raw.types.upload.File):
-                while current_part <= part_count:
-                    chunk = r.bytes
-                    if not chunk:
-                        break
-                    offset += chunk_size
-                    if part_count == 1:
-                        yield chunk[first_part_cut:last_part_cut]
-                        break
-                    if current_part == 1:
-                        yield chunk[first_part_cut:]
-                    if 1 < current_part <= part_count:
-                        yield chunk
-
-                    r = await media_session.send(
-                        raw.functions.upload.GetFile(
-                            location=location, offset=offset, limit=chunk_size
-                        ),
+            while current_part <= part_count:
+                # keep up to PARALLEL_PARTS GetFile requests in flight so the
+                # next parts are already on their way while this one is sent
+                while scheduled_parts < part_count and len(pending) < Var.PARALLEL_PARTS:
+                    pending.append(
+                        asyncio.ensure_future(
+                            self.get_part(
+                                index, file_id, offset + scheduled_parts * chunk_size, chunk_size
+                            )
+                        )
                     )
+                    scheduled_parts += 1
+
+                chunk = await pending.popleft()
+                if not chunk:
+                    break
+                # memoryview slices share the part instead of copying up to a whole part
+                if part_count == 1:
+                    chunk = memoryview(chunk)[first_part_cut:last_part_cut]
+                elif current_part == 1:
+                    chunk = memoryview(chunk)[first_part_cut:]
+                elif current_part == part_count:
+                    chunk = memoryview(chunk)[:last_part_cut]
+                scheduler.sent(index, len(chunk))
+                remaining -= len(chunk)
+                yield chunk
 
-                    current_part += 1
-        except (TimeoutError, AttributeError):
-            pass
+                current_part += 1
         finally:
-            logging.debug("Finished yielding file with {current_part} parts.")
+            # the viewer went away or the stream ended early, drop the read-ahead
+            for task in pending:
+                if task.done() and not task.cancelled() and not task.exception():
+                    wasted_bytes.inc(len(task.result()))
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            logging.debug(f"Finished yielding file with {current_part} parts.")
             work_loads[index] -= 1
+            scheduler.finish(index, remaining)
 
-    
-    async def clean_cache(self) -> None:
+    async def get_part(self, index: int, file_id: FileId, offset: int, chunk_size: int, store: bool = True) -> bytes:
+        """
+        Fetches a single part of the media file, returns empty bytes if telegram did not send a file part.
+        Parts are looked up in the shared part cache first and stored there once downloaded unless store is False,
+        concurrent requests for the same part are coalesced into a single GetFile.
+        """
+        key = (file_id.media_id, offset)
+        if chunk_size == PART_SIZE:
+            chunk = part_cache.get(key)
+            if chunk is not None:
+                popularity.hit(file_id.media_id)
+                return chunk
+        else:
+            # a small part can be cut from the cached full part holding it
+            start = offset % PART_SIZE
+            chunk = part_cache.get((file_id.media_id, offset - start))
+            if chunk is not None:
+                popularity.hit(file_id.media_id)
+                return memoryview(chunk)[start:start + chunk_size]
+        popularity.miss(file_id.media_id)
+
+        async def fetch() -> bytes:
+            chunk = await self.fetch_part(index, file_id, offset, chunk_size)
+            if store and chunk_size == PART_SIZE:
+                part_cache.put(key, chunk)
+            return chunk
+
+        # viewers asking for the same part at the same time share one request
+        return await inflight_parts.run((*key, chunk_size), fetch)
+
+    async def fetch_part(
+        self, index: int, file_id: FileId, offset: int, chunk_size: int, cdn_supported: bool = True
+    ) -> bytes:
+        """
+        Downloads a part of the media file, retrying with a backoff when telegram fails.
+        An expired file reference is refreshed from the message and the part is asked again at the same offset,
+        a part that keeps failing or hits a FloodWait is moved to another client when there is one.
+        cdn_supported is handed to request_part.
+        """
+        # streams keep the properties they started with, a reference refreshed since then is taken from the cache
+        cached = file_cache.get(file_id.message_id)
+        if cached is not None and cached.media_id == file_id.media_id:
+            file_id = cached
+        location = await self.get_location(file_id)
+        for attempt in range(Var.PART_RETRIES + 1):
+            try:
+                return await self.request_part(index, file_id, location, offset, chunk_size, cdn_supported)
+            except (FileReferenceExpired, FileReferenceInvalid):
+                if attempt == Var.PART_RETRIES:
+                    raise
+                logging.debug(f"File reference of message ID {file_id.message_id} expired, refreshing it")
+                file_id = await self.refresh_file_id(file_id)
+                location = await self.get_location(file_id)
+            except FloodWait as e:
+                if attempt == Var.PART_RETRIES:
+                    raise
+                other = self.other_client(index)
+                if other is not None:
+                    index = other
+                elif e.value <= Var.SLEEP_THRESHOLD:
+                    await asyncio.sleep(e.value)
+                else:
+                    raise
+            except (TimeoutError, OSError, InternalServerError, ServiceUnavailable) as e:
+                if attempt == Var.PART_RETRIES:
+                    raise
+                delay = min(0.5 * 2 ** attempt, 8)
+                logging.debug(f"Retrying part at offset {offset} in {delay}s after {e!r}")
+                await asyncio.sleep(delay)
+                other = self.other_client(index)
+                if attempt and other is not None:
+                    index = other
+
+    @staticmethod
+    def other_client(index: int) -> Optional[int]:
+        """
+        Returns the best client to move a failing part to, None if there is no other client.
+        """
+        others = [i for i in multi_clients if i != index]
+        return scheduler.pick(others) if others else None
+
+    async def refresh_file_id(self, file_id: FileId) -> FileId:
+        """
+        Returns the properties of the message of the file with a new file reference.
+        """
+        cached = file_cache.get(file_id.message_id)
+        if cached is not None and cached.file_reference != file_id.file_reference:
+            # another part already refreshed it
+            return cached
+        file_cache.pop(file_id.message_id)
+        return await self.get_file_properties(file_id.message_id)
+
+    async def request_part(
+        self, index: int, file_id: FileId, location, offset: int, chunk_size: int, cdn_supported: bool = True
+    ) -> bytes:
+        """
+        Downloads a part of the media file from its DC, or from the Telegram CDN when the file was redirected there.
+        Files that can't be served by the CDN anymore are downloaded from their DC again.
+        With cdn_supported off the part always comes from the DC.
+        """
+        cdn_supported = cdn_supported and not cdn_files.failed(file_id.media_id)
+        cdn_file = cdn_files.get(file_id.media_id) if cdn_supported else None
+        if cdn_file is not None:
+            try:
+                return await self.request_cdn_part(index, file_id, cdn_file, offset, chunk_size)
+            except (BadRequest, CDNFileHashMismatch, CdnUnavailable) as e:
+                logging.warning(
+                    f"CDN download failed for media {file_id.media_id}, using DC {file_id.dc_id}: {e.__cause__ or e!r}"
+                )
+                cdn_files.fail(file_id.media_id)
+                cdn_supported = False
+
+        r = await self.invoke(
+            index,
+            file_id.dc_id,
+            raw.functions.upload.GetFile(
+                location=location, offset=offset, limit=chunk_size, cdn_supported=(OFFER_CDN and cdn_supported) or None
+            ),
+        )
+        if isinstance(r, raw.types.upload.File):
+            return r.bytes
+        if isinstance(r, raw.types.upload.FileCdnRedirect):
+            logging.debug(f"Media {file_id.media_id} redirected to CDN DC {r.dc_id}")
+            cdn_files.add(file_id.media_id, r)
+            return await self.request_part(index, file_id, location, offset, chunk_size)
+        return b""
+
+    async def request_cdn_part(self, index: int, file_id: FileId, cdn_file: CdnFile, offset: int, chunk_size: int) -> bytes:
+        """
+        Downloads, decrypts and verifies a part of a file from its CDN DC.
+        Hashes cover whole blocks of HASH_BLOCK bytes, a smaller part is cut out of its block.
+        """
+        span_size = max(chunk_size, CdnFile.HASH_BLOCK)
+        span_offset = offset - offset % span_size
+        for _ in range(3):
+            try:
+                r = await self.invoke(
+                    index,
+                    cdn_file.dc_id,
+                    raw.functions.upload.GetCdnFile(
+                        file_token=cdn_file.file_token, offset=span_offset, limit=span_size
+                    ),
+                    pool=cdn_sessions,
+                )
+            except FloodWait:
+                raise
+            except Exception as e:
+                # no session to the CDN DC or a failed request, the part comes from the DC instead
+                raise CdnUnavailable from e
+            if not isinstance(r, raw.types.upload.CdnFileReuploadNeeded):
+                break
+            # the CDN doesn't have the file yet, ask the DC to push it there
+            hashes = await self.invoke(
+                index,
+                file_id.dc_id,
+                raw.functions.upload.ReuploadCdnFile(
+                    file_token=cdn_file.file_token, request_token=r.request_token
+                ),
+            )
+            cdn_file.add_hashes(hashes)
+        else:
+            raise CdnUnavailable
+
+        data = await cdn_file.decrypt(r.bytes, span_offset)
+
+        for _ in range(4):
+            missing = cdn_file.missing_hash(span_offset, len(data))
+            if missing is None:
+                break
+            hashes = await self.invoke(
+                index,
+                file_id.dc_id,
+                raw.functions.upload.GetCdnFileHashes(file_token=cdn_file.file_token, offset=missing),
+            )
+            # an answer without the hash asked for would never end the loop
+            if not cdn_file.add_hashes(hashes):
+                break
+
+        cdn_file.verify(data, span_offset)
+        if span_offset == offset and len(data) <= chunk_size:
+            return data
+        return data[offset - span_offset:offset - span_offset + chunk_size]
+
+    async def invoke(self, index: int, dc_id: int, query, pool: MediaSessionPool = media_sessions):
         """
-        function to clean the cache to reduce memory usage
+        Sends a query through a media session of the client, recording the outcome for the
+        client scheduler and the session pool.
         """
-        while True:
-            await asyncio.sleep(self.clean_timer)
-            self.cached_file_ids.clear()
-            logging.debug("Cleaned the cache")
\ No newline at end of file
+        client = multi_clients[index]
+        media_session = await pool.get(client, dc_id)
+        started = time.monotonic()
+        try:
+            with span("telegram"):
+                r = await media_session.send(query)
+        except FloodWait as e:
+            scheduler.flood_wait(index, e.value)
+            flood_waits.labels(f"bot{index + 1}").inc()
+            flood_wait_seconds.labels(f"bot{index + 1}").inc(e.value)
+            raise
+        except (TimeoutError, OSError):
+            pool.report(client, dc_id, media_session, False)
+            scheduler.record(index, time.monotonic() - started, ok=False)
+            raise
+        elapsed = time.monotonic() - started
+        pool.report(client, dc_id, media_session, True)
+        scheduler.record(index, elapsed)
+        if isinstance(r, (raw.types.upload.File, raw.types.upload.CdnFile)):
+            dc_stats.record(dc_id, len(r.bytes), elapsed)
+            get_file_seconds.labels(dc_id).observe(elapsed)
+        return r
+
+
+async def probe_dcs() -> None:
+    """
+    Keeps the latency of every known DC fresh by asking for a small part of a file
+    seen there when no real traffic measured it for a while.
+    """
+    while True:
+        await asyncio.sleep(Var.DC_PROBE_INTERVAL)
+        for dc_id, stats in list(dc_stats.dcs.items()):
+            if stats.target is None or time.monotonic() - stats.updated < Var.DC_PROBE_INTERVAL:
+                continue
+            index, file_id = stats.target
+            if index not in multi_clients:
+                continue
+            try:
+                # the probe measures the DC itself, a CDN redirect would not be followed. Going through
+                # fetch_part uses the file reference refreshed since the file was seen, or refreshes it
+                await ByteStreamer(multi_clients[index]).fetch_part(index, file_id, 0, 4096, cdn_supported=False)
+            except FIleNotFound:
+                # the message of the file is gone, the next stream from the DC gives a new target
+                stats.target = None
+            except Exception as e:
+                logging.debug(f"Probe of DC {dc_id} failed: {e!r}")
@@ -0,0 +1,86 @@
+# (c) adarsh-goel
+import time
+from typing import Dict, Optional, Tuple
+from pyrogram.file_id import FileId
+
+# largest part telegram sends, every part size must divide it
+MAX_PART_SIZE = 1024 * 1024
+# smallest part used for seek probes
+MIN_PART_SIZE = 64 * 1024
+
+
+class DcStats:
+    __slots__ = ("latency", "bandwidth", "updated", "target")
+
+    def __init__(self):
+        self.latency = 0.1  # seconds for a small part
+        self.bandwidth = 4 * 1024 * 1024  # bytes per second once a part is on its way
+        self.updated = 0.0
+        # a client index and a file on the DC that the background probe can ask for
+        self.target: Optional[Tuple[int, FileId]] = None
+
+
+class DcMonitor:
+    # weight of the newest sample in the moving averages
+    ALPHA = 0.2
+
+    def __init__(self):
+        """Live latency and bandwidth measurements of every DC files are downloaded from,
+        used to choose the part size of a request.
+        """
+        self.dcs: Dict[int, DcStats] = {}
+
+    def get(self, dc_id: int) -> DcStats:
+        stats = self.dcs.get(dc_id)
+        if stats is None:
+            stats = self.dcs[dc_id] = DcStats()
+        return stats
+
+    def seen(self, dc_id: int, index: int, file_id: FileId) -> None:
+        self.get(dc_id).target = (index, file_id)
+
+    def record(self, dc_id: int, length: int, elapsed: float) -> None:
+        """
+        Records a downloaded part, small parts measure the latency and big ones the bandwidth.
+        """
+        stats = self.get(dc_id)
+        stats.updated = time.monotonic()
+        if length <= MIN_PART_SIZE:
+            stats.latency += self.ALPHA * (elapsed - stats.latency)
+        else:
+            transfer = max(elapsed - stats.latency, 0.001)
+            stats.bandwidth += self.ALPHA * (length / transfer - stats.bandwidth)
+
+    def part_size(self, dc_id: int, from_bytes: int, until_bytes: int, min_size: int = MIN_PART_SIZE) -> int:
+        """
+        Returns the part size to serve a range with, at least min_size.
+        Bulk downloads always use the largest part, which is also the one kept in the part cache.
+        A short range inside one part, like a player looking for the moov atom, gets the smallest
+        aligned part holding it when downloading a full part would cost a noticeable part of a round trip.
+        """
+        if until_bytes - from_bytes + 1 > MAX_PART_SIZE // 2:
+            return MAX_PART_SIZE
+        size = min_size
+        # parts must be aligned to their size, so grow it until the range fits in one
+        while size < MAX_PART_SIZE and from_bytes // size != until_bytes // size:
+            size *= 2
+        if size == MAX_PART_SIZE:
+            return MAX_PART_SIZE
+        stats = self.get(dc_id)
+        extra = (MAX_PART_SIZE - size) / stats.bandwidth
+        return size if extra > stats.latency / 4 else MAX_PART_SIZE
+
+    def snapshot(self) -> dict:
+        return dict(
+            (
+                f"dc{dc_id}",
+                {
+                    "latency_ms": round(stats.latency * 1000, 1),
+                    "bandwidth_mbps": round(stats.bandwidth * 8 / 1e6, 1),
+                },
+            )
+            for dc_id, stats in sorted(self.dcs.items())
+        )
+
+
+dc_stats = DcMonitor()
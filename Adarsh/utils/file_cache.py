@@ -0,0 +1,109 @@
+# (c) adarsh-goel
+import time
+import random
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+from pyrogram.file_id import FileId
+from Adarsh.vars import Var
+from Adarsh.server.exceptions import FIleNotFound
+from .inflight import InflightTable
+
+
+class FileCache:
+    # entries expire somewhere between ttl * JITTER and ttl so they don't all expire together
+    JITTER = 0.8
+
+    def __init__(self, ttl: int, max_entries: int, missing_ttl: int):
+        """A process wide cache of file properties by message ID, shared by every client.
+        Message IDs without a file are remembered too so asking for them again doesn't reach Telegram.
+        attributes:
+            ttl: seconds an entry stays valid.
+            max_entries: the least recently used entries are evicted past this size.
+            missing_ttl: seconds a message ID without a file stays known as missing, 0 disables it.
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.missing_ttl = missing_ttl
+        self.hits = 0
+        self.misses = 0
+        self.missing_hits = 0
+        self._entries: "OrderedDict[int, Tuple[float, FileId]]" = OrderedDict()
+        self._missing: "OrderedDict[int, float]" = OrderedDict()
+        self._loads = InflightTable()
+
+    def get(self, id: int) -> Optional[FileId]:
+        entry = self._entries.get(id)
+        if entry is None:
+            return None
+        expires, file_id = entry
+        if expires < time.monotonic():
+            del self._entries[id]
+            return None
+        self._entries.move_to_end(id)
+        return file_id
+
+    def put(self, id: int, file_id: FileId) -> None:
+        expires = time.monotonic() + self.ttl * random.uniform(self.JITTER, 1)
+        self._entries[id] = (expires, file_id)
+        self._entries.move_to_end(id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def pop(self, id: int) -> None:
+        self._entries.pop(id, None)
+        self._missing.pop(id, None)
+
+    def is_missing(self, id: int) -> bool:
+        expires = self._missing.get(id)
+        if expires is None:
+            return False
+        if expires < time.monotonic():
+            del self._missing[id]
+            return False
+        return True
+
+    def put_missing(self, id: int) -> None:
+        if not self.missing_ttl:
+            return
+        self._missing[id] = time.monotonic() + self.missing_ttl
+        self._missing.move_to_end(id)
+        while len(self._missing) > self.max_entries:
+            self._missing.popitem(last=False)
+
+    async def get_or_load(self, id: int, loader: Callable[[], Awaitable[FileId]]) -> FileId:
+        """
+        Returns the cached properties of the message, or loads and caches them.
+        Concurrent misses for the same message share a single load.
+        Raises FIleNotFound at once for a message known to have no file.
+        """
+        file_id = self.get(id)
+        if file_id is not None:
+            self.hits += 1
+            return file_id
+        if self.is_missing(id):
+            self.missing_hits += 1
+            raise FIleNotFound
+        self.misses += 1
+
+        async def load() -> FileId:
+            try:
+                file_id = await loader()
+            except FIleNotFound:
+                self.put_missing(id)
+                raise
+            self.put(id, file_id)
+            return file_id
+
+        return await self._loads.run(id, load)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "missing": len(self._missing),
+            "missing_hits": self.missing_hits,
+        }
+
+
+file_cache = FileCache(Var.FILE_CACHE_TTL, Var.FILE_CACHE_SIZE, Var.MISSING_TTL)
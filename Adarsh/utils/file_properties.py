@@ -4,6 +4,7 @@ from pyrogram.types import Message
 from pyrogram.file_id import FileId
 from pyrogram.raw.types.messages import Messages
 from Adarsh.server.exceptions import FIleNotFound
+from Adarsh.utils.message_loader import message_loader
 
 
 async def parse_file_id(message: "Message") -> Optional[FileId]:
@@ -17,16 +18,21 @@ async def parse_file_unique_id(message: "Messages") -> Optional[str]:
         return media.file_unique_id
 
 async def get_file_ids(client: Client, chat_id: int, id: int) -> Optional[FileId]:
-    message = await client.get_messages(chat_id, id)
-    if message.empty:
+    message = await message_loader.load(client, chat_id, id)
+    if message is None or message.empty:
         raise FIleNotFound
     media = get_media_from_message(message)
+    if media is None:
+        # like the log lines the bot replies with between the files
+        raise FIleNotFound
     file_unique_id = await parse_file_unique_id(message)
     file_id = await parse_file_id(message)
     setattr(file_id, "file_size", getattr(media, "file_size", 0))
     setattr(file_id, "mime_type", getattr(media, "mime_type", ""))
     setattr(file_id, "file_name", getattr(media, "file_name", ""))
     setattr(file_id, "unique_id", file_unique_id)
+    setattr(file_id, "date", message.date)
+    setattr(file_id, "message_id", id)
     return file_id
 
 def get_media_from_message(message: "Message") -> Any:
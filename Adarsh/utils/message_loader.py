@@ -0,0 +1,77 @@
+# (c) adarsh-goel
+import asyncio
+from typing import Dict, List, Optional, Tuple
+from pyrogram import Client
+from pyrogram.types import Message
+from Adarsh.vars import Var
+
+
+class MessageLoader:
+    # the most message IDs messages.GetMessages accepts at once
+    MAX_BATCH = 200
+
+    def __init__(self, window: float):
+        """Collects the messages asked for by concurrent requests and fetches them with a single
+        get_messages call per client and chat, so opening a post with many links or walking message
+        IDs doesn't send one request per message.
+        attributes:
+            window: seconds to wait for more message IDs before a batch is sent.
+            batches: the number of get_messages calls sent.
+            loaded: the number of messages fetched.
+        """
+        self.window = window
+        self.batches = 0
+        self.loaded = 0
+        self._pending: Dict[Tuple[Client, int], Dict[int, List[asyncio.Future]]] = {}
+        self._timers: Dict[Tuple[Client, int], asyncio.TimerHandle] = {}
+
+    async def load(self, client: Client, chat_id: int, message_id: int) -> Optional[Message]:
+        """
+        Returns a message of the chat, fetched in a batch with the other messages asked for meanwhile.
+        Returns None if telegram did not send it back.
+        """
+        key = (client, chat_id)
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        pending = self._pending.setdefault(key, {})
+        pending.setdefault(message_id, []).append(future)
+
+        if len(pending) >= self.MAX_BATCH:
+            self._flush(key)
+        elif key not in self._timers:
+            self._timers[key] = loop.call_later(self.window, self._flush, key)
+        return await future
+
+    def _flush(self, key: Tuple[Client, int]) -> None:
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        pending = self._pending.pop(key, None)
+        if pending:
+            asyncio.create_task(self._fetch(key, pending))
+
+    async def _fetch(self, key: Tuple[Client, int], pending: Dict[int, List[asyncio.Future]]) -> None:
+        client, chat_id = key
+        message_ids = list(pending)
+        self.batches += 1
+        try:
+            messages = await client.get_messages(chat_id, message_ids)
+        except Exception as e:
+            for futures in pending.values():
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+            return
+        self.loaded += len(messages)
+        # matched by ID rather than by position, missing ones come back as empty messages with their ID
+        found = dict((message.id, message) for message in messages if message is not None)
+        for message_id, futures in pending.items():
+            for future in futures:
+                if not future.done():
+                    future.set_result(found.get(message_id))
+
+    def stats(self) -> Dict[str, int]:
+        return {"batches": self.batches, "loaded": self.loaded}
+
+
+message_loader = MessageLoader(Var.BATCH_WINDOW)
@@ -0,0 +1,176 @@
+# (c) adarsh-goel
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+# a function returning the current samples of a metric by label values, read when /metrics is scraped
+Collector = Callable[[], Dict[Tuple[str, ...], float]]
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), collect: Optional[Collector] = None):
+        """A metric family in the Prometheus text format.
+        Metrics are only touched from the event loop so they need no locks, and a metric that
+        mirrors a value already kept somewhere else reads it through collect at scrape time only.
+        attributes:
+            name: the metric name.
+            help: what the metric measures.
+            labelnames: the names of the labels of the samples.
+            collect: called at scrape time for the samples instead of keeping them.
+        """
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.collect = collect
+        self._children: Dict[Tuple[str, ...], object] = {}
+        registry.append(self)
+
+    def labels(self, *values) -> object:
+        """
+        Returns the child of the metric for the label values, hot paths should keep it around.
+        """
+        values = tuple(map(str, values))
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._child()
+        return child
+
+    def _child(self) -> object:
+        raise NotImplementedError
+
+    def _label_string(self, values: Tuple[str, ...], extra: str = "") -> str:
+        pairs = [f'{name}="{_escape(value)}"' for name, value in zip(self.labelnames, values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        if self.collect is not None:
+            for values, value in self.collect().items():
+                lines.append(f"{self.name}{self._label_string(values)} {value}")
+            return lines
+        if not self.labelnames:
+            # a metric without labels has one sample, shown even before it is used
+            self.labels()
+        for values, child in self._children.items():
+            lines.extend(self._render_child(values, child))
+        return lines
+
+    def _render_child(self, values: Tuple[str, ...], child) -> List[str]:
+        return [f"{self.name}{self._label_string(values)} {child.value}"]
+
+
+class _Value:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        self.value -= amount
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def _child(self) -> _Value:
+        return _Value()
+
+    @property
+    def value(self) -> float:
+        return self.labels().value
+
+    def inc(self, amount: float = 1) -> None:
+        self.labels().inc(amount)
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def set(self, value: float) -> None:
+        self.labels().set(value)
+
+
+class _Buckets:
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        # only the bucket of the value is counted, the cumulative counts are summed at scrape time
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Histogram(Metric):
+    type = "histogram"
+    # seconds, from a cached part to a slow foreign DC
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _child(self) -> _Buckets:
+        return _Buckets(self.buckets)
+
+    def observe(self, value: float) -> None:
+        self.labels().observe(value)
+
+    def _render_child(self, values: Tuple[str, ...], child: _Buckets) -> List[str]:
+        lines = []
+        total = 0
+        for bound, count in zip(child.bounds + (float("inf"),), child.counts):
+            total += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            le_label = f'le="{le}"'
+            lines.append(f"{self.name}_bucket{self._label_string(values, le_label)} {total}")
+        lines.append(f"{self.name}_sum{self._label_string(values)} {child.sum}")
+        lines.append(f"{self.name}_count{self._label_string(values)} {child.count}")
+        return lines
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def render() -> str:
+    """
+    Returns every metric in the Prometheus text exposition format.
+    """
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+registry: List[Metric] = []
+
+wasted_bytes = Counter("stream_wasted_bytes_total", "Bytes downloaded from Telegram that were never sent to a viewer")
+sent_bytes = Counter("stream_sent_bytes_total", "Bytes sent to viewers", ["client"])
+get_file_seconds = Histogram("telegram_get_file_seconds", "Time taken by GetFile requests", ["dc"])
+flood_waits = Counter("telegram_flood_waits_total", "FloodWait errors received", ["client"])
+flood_wait_seconds = Counter("telegram_flood_wait_seconds_total", "Seconds of FloodWait imposed", ["client"])
+http_responses = Counter("http_responses_total", "HTTP responses sent", ["route", "status"])
+http_ttfb_seconds = Histogram(
+    "http_time_to_first_byte_seconds", "Time from receiving a request to sending the response headers", ["route"]
+)
+bandwidth_granted_bytes = Counter(
+    "bandwidth_granted_bytes_total", "Bytes let through by the bandwidth scheduler", ["priority"]
+)
+bandwidth_throttled_seconds = Counter(
+    "bandwidth_throttled_seconds_total", "Time streams waited for the bandwidth scheduler", ["priority"]
+)
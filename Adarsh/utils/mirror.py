@@ -0,0 +1,161 @@
+# (c) adarsh-goel
+import os
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import IO, Awaitable, Callable, Dict, Optional
+from Adarsh.vars import Var
+from .dc_stats import MAX_PART_SIZE
+from .popularity import Popularity, popularity
+from .tracing import detach
+
+
+class DiskMirror:
+    # files downloaded to the mirror at the same time
+    MAX_JOBS = 2
+
+    def __init__(self, directory: str, max_bytes: int, min_requests: int, part_size: int, popularity: Popularity):
+        """A size capped directory holding local copies of the most requested files, named by media ID.
+        Files are downloaded in the background once they are popular enough, and only when they are
+        at least as popular as the least recently served files that would be deleted to make room.
+        attributes:
+            directory: where the files are kept, an empty string disables the mirror.
+            max_bytes: the most bytes the mirrored files may use together, a file can use a quarter of it.
+            min_requests: the popularity, in viewers, after which a file is mirrored.
+            used: the bytes used by the mirrored files.
+            hits: the number of requests served from the mirror.
+            mirrored: the number of files mirrored since start.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.min_requests = min_requests
+        self.part_size = part_size
+        self.popularity = popularity
+        self.used = 0
+        self.hits = 0
+        self.mirrored = 0
+        self._files: "OrderedDict[int, int]" = OrderedDict()
+        self._jobs: Dict[int, asyncio.Task] = {}
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self._load()
+
+    def _load(self) -> None:
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".part"):
+                # left over by a mirror that did not finish
+                os.remove(entry.path)
+            elif entry.name.isdigit():
+                entries.append(entry)
+        for entry in sorted(entries, key=lambda e: e.stat().st_mtime):
+            size = entry.stat().st_size
+            self._files[int(entry.name)] = size
+            self.used += size
+
+    def path(self, media_id: int) -> str:
+        return os.path.join(self.directory, str(media_id))
+
+    async def open(self, media_id: int, file_size: int) -> Optional[IO[bytes]]:
+        """
+        Returns the mirrored copy of a file opened for reading, or None when it is not mirrored.
+        """
+        if self._files.get(media_id) != file_size:
+            return None
+        try:
+            fobj = await asyncio.get_running_loop().run_in_executor(None, open, self.path(media_id), "rb")
+        except OSError:
+            logging.warning(f"Mirrored file {media_id} is gone", exc_info=True)
+            self.used -= self._files.pop(media_id, 0)
+            return None
+        self._files.move_to_end(media_id)
+        self.hits += 1
+        return fobj
+
+    def request(self, media_id: int, file_size: int, fetch: Callable[[int], Awaitable[bytes]]) -> None:
+        """
+        Called for every request of a file served from Telegram, starts mirroring it in the background
+        once it is popular enough. The viewer never waits for the mirror.
+        """
+        if not self.directory or media_id in self._files or media_id in self._jobs:
+            return
+        if file_size > self.max_bytes // 4 or len(self._jobs) >= self.MAX_JOBS:
+            return
+        if self.popularity.frequency(media_id) < self.min_requests or not self._admit(media_id, file_size):
+            return
+        self._jobs[media_id] = asyncio.create_task(self._mirror(media_id, file_size, fetch))
+
+    async def _mirror(self, media_id: int, file_size: int, fetch: Callable[[int], Awaitable[bytes]]) -> None:
+        detach()
+        loop = asyncio.get_running_loop()
+        path = self.path(media_id)
+        temp_path = path + ".part"
+        try:
+            fobj = await loop.run_in_executor(None, open, temp_path, "wb")
+            try:
+                for offset in range(0, file_size, self.part_size):
+                    chunk = await fetch(offset)
+                    if not chunk:
+                        raise EOFError(f"Telegram sent no part at offset {offset}")
+                    await loop.run_in_executor(None, fobj.write, chunk)
+            finally:
+                await loop.run_in_executor(None, fobj.close)
+            if os.path.getsize(temp_path) != file_size:
+                raise EOFError("Telegram sent less bytes than the file size")
+            await self._make_room(file_size)
+            await loop.run_in_executor(None, os.replace, temp_path, path)
+            self._files[media_id] = file_size
+            self.used += file_size
+            self.mirrored += 1
+            logging.debug(f"Mirrored file {media_id} of {file_size} bytes")
+        except BaseException as e:
+            await loop.run_in_executor(None, self._remove, temp_path)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            logging.warning(f"Failed to mirror file {media_id}: {e!r}")
+        finally:
+            del self._jobs[media_id]
+
+    def _admit(self, media_id: int, size: int) -> bool:
+        # the files that would be deleted to make room must not be more popular
+        free = self.max_bytes - self.used
+        for victim, victim_size in self._files.items():
+            if free >= size:
+                break
+            if not self.popularity.admit(media_id, victim):
+                return False
+            free += victim_size
+        return True
+
+    async def _make_room(self, size: int) -> None:
+        loop = asyncio.get_running_loop()
+        while self._files and self.used + size > self.max_bytes:
+            # a viewer still reading an evicted file keeps its open copy
+            media_id, evicted = self._files.popitem(last=False)
+            self.used -= evicted
+            await loop.run_in_executor(None, self._remove, self.path(media_id))
+
+    @staticmethod
+    def _remove(path: str) -> None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    async def stop(self) -> None:
+        tasks = list(self._jobs.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "files": len(self._files),
+            "used": self.used,
+            "hits": self.hits,
+            "mirrored": self.mirrored,
+            "in_progress": len(self._jobs),
+        }
+
+
+mirror = DiskMirror(Var.MIRROR_DIR, Var.MIRROR_SIZE * 1024 * 1024 * 1024, Var.MIRROR_REQUESTS, MAX_PART_SIZE, popularity)
@@ -0,0 +1,69 @@
+# (c) adarsh-goel
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, Optional
+from Adarsh.vars import Var
+from .popularity import popularity
+
+
+class PartCache:
+    def __init__(self, max_bytes: int, admit: Optional[Callable[[int, int], bool]] = None):
+        """A process wide LRU cache of downloaded file parts with a memory budget in bytes.
+        Keys start with the media ID of the part.
+        attributes:
+            max_bytes: the memory budget of the cache, 0 disables it.
+            max_item: parts bigger than this are never cached so one of them can't flush the cache.
+            admit: called with the media IDs of a new part and of the part it would evict once the cache
+                is full, the new part is dropped when it returns False.
+            size: the number of bytes currently held.
+            rejected: the number of parts not admitted.
+        """
+        self.max_bytes = max_bytes
+        self.max_item = max_bytes // 8
+        self.admit = admit
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.rejected = 0
+        self._parts: "OrderedDict[Hashable, bytes]" = OrderedDict()
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._parts
+
+    def get(self, key: Hashable) -> Optional[bytes]:
+        data = self._parts.get(key)
+        if data is None:
+            self.misses += 1
+            return None
+        self._parts.move_to_end(key)
+        self.hits += 1
+        return data
+
+    def put(self, key: Hashable, data: bytes) -> None:
+        if not data or len(data) > self.max_item:
+            return
+        old = self._parts.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        elif self._parts and self.admit is not None and self.size + len(data) > self.max_bytes:
+            victim = next(iter(self._parts))
+            if not self.admit(key[0], victim[0]):
+                self.rejected += 1
+                return
+        while self._parts and self.size + len(data) > self.max_bytes:
+            _, evicted = self._parts.popitem(last=False)
+            self.size -= len(evicted)
+        self._parts[key] = data
+        self.size += len(data)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "parts": len(self._parts),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "rejected": self.rejected,
+        }
+
+
+part_cache = PartCache(Var.CACHE_SIZE * 1024 * 1024, popularity.admit)
\ No newline at end of file
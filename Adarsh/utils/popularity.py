@@ -0,0 +1,127 @@
+# (c) adarsh-goel
+from collections import OrderedDict
+from typing import Dict, Hashable, List, Set
+
+
+class CountMinSketch:
+    # seeds of the hash of every row
+    SEEDS = (0x9E3779B1, 0x85EBCA77, 0xC2B2AE3D, 0x27D4EB2F)
+
+    def __init__(self, width: int, sample_size: int):
+        """A count-min sketch of how often keys were seen, with counters halved every sample_size
+        increments so the counts follow what is popular now rather than since start.
+        attributes:
+            width: the number of counters in every row, rounded up to a power of two.
+            sample_size: the number of increments between two agings.
+            additions: the number of increments since the last aging.
+        """
+        self.width = 1 << max(width - 1, 1).bit_length()
+        self.mask = self.width - 1
+        self.sample_size = sample_size
+        self.additions = 0
+        self._rows: List[List[int]] = [[0] * self.width for _ in self.SEEDS]
+
+    def _indexes(self, key: Hashable):
+        return (hash((seed, key)) & self.mask for seed in self.SEEDS)
+
+    def increment(self, key: Hashable) -> bool:
+        """
+        Counts the key once, returns whether the counters were aged.
+        """
+        for row, i in zip(self._rows, self._indexes(key)):
+            row[i] += 1
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            self.age()
+            return True
+        return False
+
+    def estimate(self, key: Hashable) -> int:
+        return min(row[i] for row, i in zip(self._rows, self._indexes(key)))
+
+    def age(self) -> None:
+        for row in self._rows:
+            for i, count in enumerate(row):
+                row[i] = count >> 1
+        self.additions >>= 1
+
+
+class FileStats:
+    __slots__ = ("message_id", "requests", "hits", "misses")
+
+    def __init__(self, message_id: int):
+        self.message_id = message_id
+        self.requests = 0
+        self.hits = 0
+        self.misses = 0
+
+
+class Popularity:
+    def __init__(self, width: int = 16384, max_tracked: int = 10000):
+        """How popular every file is lately, used to decide what the part cache and the disk mirror keep.
+        A file is counted once per viewer between two agings, so a download accelerator opening many
+        connections for one file doesn't look like many viewers.
+        attributes:
+            sketch: the frequency of every media ID.
+            files: the recently requested files with their requests and the cache hits and misses of their parts.
+        """
+        self.sketch = CountMinSketch(width, width * 10)
+        self.max_tracked = max_tracked
+        self.files: "OrderedDict[int, FileStats]" = OrderedDict()
+        self._seen: Set[int] = set()
+
+    def record(self, viewer: Hashable, media_id: int, message_id: int) -> None:
+        """
+        Records a request of a viewer for a file.
+        """
+        stats = self.files.get(media_id)
+        if stats is None:
+            stats = self.files[media_id] = FileStats(message_id)
+            while len(self.files) > self.max_tracked:
+                self.files.popitem(last=False)
+        self.files.move_to_end(media_id)
+        stats.requests += 1
+
+        # the doorkeeper, a viewer counts once for a file until the next aging
+        seen = hash((viewer, media_id))
+        if seen in self._seen:
+            return
+        self._seen.add(seen)
+        if self.sketch.increment(media_id):
+            self._seen.clear()
+
+    def frequency(self, media_id: int) -> int:
+        return self.sketch.estimate(media_id)
+
+    def admit(self, candidate: int, victim: int) -> bool:
+        """
+        Returns whether a part or file of the candidate media ID may replace one of the victim,
+        newcomers win ties so that equally popular files are still kept by recency.
+        """
+        return candidate == victim or self.frequency(candidate) >= self.frequency(victim)
+
+    def hit(self, media_id: int, parts: int = 1) -> None:
+        stats = self.files.get(media_id)
+        if stats is not None:
+            stats.hits += parts
+
+    def miss(self, media_id: int) -> None:
+        stats = self.files.get(media_id)
+        if stats is not None:
+            stats.misses += 1
+
+    def top(self, n: int) -> List[Dict[str, object]]:
+        ranked = sorted(self.files.items(), key=lambda item: self.frequency(item[0]), reverse=True)
+        return [
+            {
+                "media_id": media_id,
+                "message_id": stats.message_id,
+                "frequency": self.frequency(media_id),
+                "requests": stats.requests,
+                "hit_rate": round(stats.hits / (stats.hits + stats.misses), 3) if stats.hits + stats.misses else None,
+            }
+            for media_id, stats in ranked[:n]
+        ]
+
+
+popularity = Popularity()
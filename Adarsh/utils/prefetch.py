@@ -0,0 +1,118 @@
+# (c) adarsh-goel
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Awaitable, Callable, Hashable, Optional, Tuple
+from Adarsh.vars import Var
+from .dc_stats import MAX_PART_SIZE
+from .tracing import detach
+
+
+class _Access:
+    __slots__ = ("next_offset", "streak", "task")
+
+    def __init__(self):
+        # None until the viewer made a request, a first request is never sequential
+        self.next_offset: Optional[int] = None
+        self.streak = 0
+        self.task: Optional[asyncio.Task] = None
+
+    def cancel(self) -> None:
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+        self.task = None
+
+
+class Prefetcher:
+    def __init__(self, parts: int, part_size: int, budget: int, max_viewers: int = 10000):
+        """Detects viewers reading a file as a series of back to back Range requests, like video players do,
+        and downloads the parts right after the current request into the part cache before they are asked for.
+        attributes:
+            parts: the number of parts fetched ahead of a sequential viewer, 0 disables prefetching.
+            part_size: the size of the parts, the one kept by the part cache.
+            budget: the most bytes that all prefetches may have in flight together.
+            prefetched: the number of bytes prefetched since start.
+        """
+        self.parts = parts
+        self.part_size = part_size
+        self.budget = budget
+        self.in_flight = 0
+        self.prefetched = 0
+        self.max_viewers = max_viewers
+        self._viewers: "OrderedDict[Tuple[Hashable, int], _Access]" = OrderedDict()
+
+    def start(
+        self,
+        viewer: Hashable,
+        media_id: int,
+        from_bytes: int,
+        until_bytes: int,
+        file_size: int,
+        fetch: Callable[[int], Awaitable[bytes]],
+        is_cached: Callable[[int], bool],
+    ) -> None:
+        """
+        Records a new request of a viewer, a request starting where the last one ended continues
+        a sequential read and the parts after it are prefetched, any other request is a seek that
+        drops the running prefetch.
+        """
+        if not self.parts:
+            return
+        key = (viewer, media_id)
+        access = self._viewers.get(key)
+        if access is None:
+            access = self._viewers[key] = _Access()
+            while len(self._viewers) > self.max_viewers:
+                self._viewers.popitem(last=False)[1].cancel()
+        self._viewers.move_to_end(key)
+
+        if access.next_offset is not None and abs(from_bytes - access.next_offset) < self.part_size:
+            access.streak += 1
+        else:
+            access.streak = 0
+            access.cancel()
+        access.next_offset = until_bytes + 1
+
+        if access.streak == 0 or access.task is not None:
+            return
+        first = (until_bytes // self.part_size + 1) * self.part_size
+        offsets = [
+            offset
+            for offset in range(first, min(first + self.parts * self.part_size, file_size), self.part_size)
+            if not is_cached(offset)
+        ]
+        reserved = len(offsets) * self.part_size
+        if offsets and self.in_flight + reserved <= self.budget:
+            # the bytes count against the budget from now, not once the task runs, so requests arriving
+            # together can't all pass the check. They are given back when the task is done, a task
+            # cancelled before it ran never reaches a finally of its own
+            self.in_flight += reserved
+            access.task = asyncio.create_task(self._prefetch(access, offsets, fetch))
+            access.task.add_done_callback(lambda _: self._release(reserved))
+
+    def _release(self, reserved: int) -> None:
+        self.in_flight -= reserved
+
+    def stop(self, viewer: Hashable, media_id: int) -> None:
+        """
+        Drops the prefetch of a viewer that went away.
+        """
+        access = self._viewers.pop((viewer, media_id), None)
+        if access is not None:
+            access.cancel()
+
+    async def _prefetch(self, access: _Access, offsets, fetch: Callable[[int], Awaitable[bytes]]) -> None:
+        detach()
+        try:
+            for chunk in await asyncio.gather(*(fetch(offset) for offset in offsets)):
+                self.prefetched += len(chunk)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.debug(f"Prefetch failed: {e!r}")
+        finally:
+            if access.task is asyncio.current_task():
+                access.task = None
+
+
+prefetcher = Prefetcher(Var.PREFETCH_PARTS, MAX_PART_SIZE, Var.PREFETCH_BUDGET * 1024 * 1024)
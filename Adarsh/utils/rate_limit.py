@@ -0,0 +1,56 @@
+# (c) adarsh-goel
+import time
+from collections import OrderedDict
+from typing import Dict, Hashable, Tuple
+from Adarsh.vars import Var
+
+
+class FailureLimiter:
+    def __init__(self, per_minute: int, max_tracked: int = 100000):
+        """Counts the failed requests, like 403 and 404 answers, of every IP in a token bucket
+        refilled at per_minute tokens a minute. An IP that used up its bucket is refused until
+        a token is back, before any lookup is done for it.
+        attributes:
+            per_minute: failures allowed per minute, also the size of the bucket. 0 disables the limiter.
+            refused: the number of requests refused since start.
+        """
+        self.per_minute = per_minute
+        self.rate = per_minute / 60
+        self.max_tracked = max_tracked
+        self.refused = 0
+        # tokens left and the time they were counted
+        self._buckets: "OrderedDict[Hashable, Tuple[float, float]]" = OrderedDict()
+
+    def _tokens(self, key: Hashable, now: float) -> float:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            return float(self.per_minute)
+        tokens, updated = bucket
+        return min(self.per_minute, tokens + (now - updated) * self.rate)
+
+    def retry_after(self, key: Hashable) -> float:
+        """
+        Returns the seconds until the IP may be served again, 0 if it can be served now.
+        """
+        if not self.per_minute or key not in self._buckets:
+            return 0
+        tokens = self._tokens(key, time.monotonic())
+        if tokens >= 1:
+            return 0
+        self.refused += 1
+        return (1 - tokens) / self.rate
+
+    def failed(self, key: Hashable) -> None:
+        if not self.per_minute:
+            return
+        now = time.monotonic()
+        self._buckets[key] = (max(self._tokens(key, now) - 1, 0), now)
+        self._buckets.move_to_end(key)
+        while len(self._buckets) > self.max_tracked:
+            self._buckets.popitem(last=False)
+
+    def stats(self) -> Dict[str, int]:
+        return {"tracked": len(self._buckets), "refused": self.refused}
+
+
+bad_requests = FailureLimiter(Var.BAD_REQUEST_LIMIT)
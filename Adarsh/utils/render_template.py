@@ -2,35 +2,48 @@ from Adarsh.vars import Var
 from Adarsh.bot import StreamBot
 from Adarsh.utils.human_readable import humanbytes
 from Adarsh.utils.file_properties import get_file_ids
+from Adarsh.utils.file_cache import file_cache
+from Adarsh.utils.signed_links import link_path
 from Adarsh.server.exceptions import InvalidHash
 import urllib.parse
-import aiofiles
 import logging
-import aiohttp
+import os
 
 
-async def render_page(id, secure_hash):
-    file_data=await get_file_ids(StreamBot, int(Var.BIN_CHANNEL), int(id))
-    if file_data.unique_id[:6] != secure_hash:
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'template')
+
+
+def load_template(name):
+    with open(os.path.join(TEMPLATE_DIR, name)) as r:
+        return r.read()
+
+
+# templates are read once at startup, the player template is prepared for each media tag
+_player_template = load_template('req.html')
+TEMPLATES = {
+    'video': _player_template.replace('tag', 'video'),
+    'audio': _player_template.replace('tag', 'audio'),
+    'download': load_template('dl.html'),
+}
+
+
+async def render_page(id, secure_hash, signature=None):
+    file_data=await file_cache.get_or_load(int(id), lambda: get_file_ids(StreamBot, int(Var.BIN_CHANNEL), int(id)))
+    # a signed link was verified by the route already
+    if not signature and file_data.unique_id[:6] != secure_hash:
         logging.debug(f'link hash: {secure_hash} - {file_data.unique_id[:6]}')
         logging.debug(f"Invalid hash for message with - ID {id}")
         raise InvalidHash
-    src = urllib.parse.urljoin(Var.URL, f'{secure_hash}{str(id)}')
-    if str(file_data.mime_type.split('/')[0].strip()) == 'video':
-        async with aiofiles.open('Adarsh/template/req.html') as r:
-            heading = 'Watch {}'.format(file_data.file_name)
-            tag = file_data.mime_type.split('/')[0].strip()
-            html = (await r.read()).replace('tag', tag) % (heading, file_data.file_name, src)
-    elif str(file_data.mime_type.split('/')[0].strip()) == 'audio':
-        async with aiofiles.open('Adarsh/template/req.html') as r:
-            heading = 'Listen {}'.format(file_data.file_name)
-            tag = file_data.mime_type.split('/')[0].strip()
-            html = (await r.read()).replace('tag', tag) % (heading, file_data.file_name, src)
+    src = urllib.parse.urljoin(Var.URL, link_path(int(id), secure_hash, signature))
+    tag = str(file_data.mime_type.split('/')[0].strip())
+    if tag == 'video':
+        heading = 'Watch {}'.format(file_data.file_name)
+        html = TEMPLATES['video'] % (heading, file_data.file_name, src)
+    elif tag == 'audio':
+        heading = 'Listen {}'.format(file_data.file_name)
+        html = TEMPLATES['audio'] % (heading, file_data.file_name, src)
     else:
-        async with aiofiles.open('Adarsh/template/dl.html') as r:
-            async with aiohttp.ClientSession() as s:
-                async with s.get(src) as u:
-                    heading = 'Download {}'.format(file_data.file_name)
-                    file_size = humanbytes(int(u.headers.get('Content-Length')))
-                    html = (await r.read()) % (heading, file_data.file_name, src, file_size)
-    return html
\ No newline at end of file
+        heading = 'Download {}'.format(file_data.file_name)
+        file_size = humanbytes(file_data.file_size)
+        html = TEMPLATES['download'] % (heading, file_data.file_name, src, file_size)
+    return html
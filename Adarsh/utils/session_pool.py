@@ -0,0 +1,194 @@
+# (c) adarsh-goel
+import time
+import asyncio
+import logging
+from typing import Dict, List, Tuple
+from Adarsh.vars import Var
+from pyrogram import Client, raw
+from pyrogram.session import Session, Auth
+from pyrogram.errors import AuthBytesInvalid
+from pyrogram.session.internals import DataCenter
+from .cdn import CdnUnavailable
+from .tracing import detach, span
+
+
+class MediaSessionPool:
+    # consecutive failed requests after which a session is considered dead
+    MAX_FAILURES = 2
+    # seconds before filling a pool again after a failure, doubled on every failure in a row
+    FILL_BACKOFF = 5
+    MAX_FILL_BACKOFF = 300
+
+    def __init__(self, size: int, is_cdn: bool = False):
+        """A pool of media sessions for every (client, DC) pair.
+        Sessions are created one at a time per pair, so concurrent first requests for a DC
+        don't all run the auth export/import, and requests are spread over the live sessions.
+        attributes:
+            size: the number of sessions kept for each (client, DC) pair.
+            is_cdn: whether the pool holds sessions to Telegram CDN DCs.
+            created: the number of media sessions created since start.
+        """
+        self.size = size
+        self.is_cdn = is_cdn
+        self.created = 0
+        self._sessions: Dict[Tuple[Client, int], List[Session]] = {}
+        self._locks: Dict[Tuple[Client, int], asyncio.Lock] = {}
+        self._failures: Dict[Session, int] = {}
+        self._fillers: Dict[Tuple[Client, int], asyncio.Task] = {}
+        # the last failed fill of a pair: when it may be tried again and the backoff used
+        self._fill_failures: Dict[Tuple[Client, int], Tuple[float, float]] = {}
+        self._turn = 0
+
+    async def get(self, client: Client, dc_id: int) -> Session:
+        """
+        Returns a media session of the client for the DC, creating the first one if needed.
+        The rest of the pool is filled in the background.
+        """
+        key = (client, dc_id)
+        sessions = self._sessions.get(key)
+        if not sessions:
+            with span("cdn_session" if self.is_cdn else "session"):
+                async with self._lock(key):
+                    sessions = self._sessions.get(key)
+                    if not sessions:
+                        sessions = self._sessions[key] = [await self._create(client, dc_id)]
+        if len(sessions) < self.size and key not in self._fillers and self._may_fill(key):
+            self._fillers[key] = asyncio.create_task(self._fill(key))
+
+        connected = [s for s in sessions if s.is_connected.is_set()] or sessions
+        self._turn += 1
+        return connected[self._turn % len(connected)]
+
+    def report(self, client: Client, dc_id: int, session: Session, ok: bool) -> None:
+        """
+        Records the outcome of a request sent through a session of the pool.
+        Sessions failing too many times in a row are dropped and replaced.
+        """
+        if ok:
+            self._failures.pop(session, None)
+            return
+        failures = self._failures[session] = self._failures.get(session, 0) + 1
+        if failures >= self.MAX_FAILURES:
+            self._failures.pop(session, None)
+            sessions = self._sessions.get((client, dc_id), [])
+            if session in sessions:
+                sessions.remove(session)
+                logging.warning(f"Dropped dead media session for DC {dc_id}")
+                asyncio.create_task(self._stop(session))
+
+    async def stop(self) -> None:
+        for task in self._fillers.values():
+            task.cancel()
+        for sessions in self._sessions.values():
+            for session in sessions:
+                await self._stop(session)
+        self._sessions.clear()
+
+    async def _fill(self, key: Tuple[Client, int]) -> None:
+        detach()
+        client, dc_id = key
+        try:
+            while len(self._sessions.get(key, [])) < self.size:
+                async with self._lock(key):
+                    session = await self._create(client, dc_id)
+                    self._sessions.setdefault(key, []).append(session)
+        except Exception:
+            _, backoff = self._fill_failures.get(key, (0.0, self.FILL_BACKOFF / 2))
+            backoff = min(backoff * 2, self.MAX_FILL_BACKOFF)
+            self._fill_failures[key] = (time.monotonic() + backoff, backoff)
+            logging.warning(
+                f"Failed to add a media session for DC {dc_id}, trying again in {backoff:.0f}s", exc_info=True
+            )
+        else:
+            self._fill_failures.pop(key, None)
+        finally:
+            del self._fillers[key]
+
+    def _may_fill(self, key: Tuple[Client, int]) -> bool:
+        failure = self._fill_failures.get(key)
+        return failure is None or time.monotonic() >= failure[0]
+
+    async def _create(self, client: Client, dc_id: int) -> Session:
+        if self.is_cdn and dc_id not in DataCenter.PROD:
+            # pyrogram can only connect to the DCs of its table, CDN DCs are not in it
+            raise CdnUnavailable(f"pyrogram has no address for CDN DC {dc_id}")
+        return await self.create_session(client, dc_id)
+
+    def _lock(self, key: Tuple[Client, int]) -> asyncio.Lock:
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        return lock
+
+    @staticmethod
+    async def _stop(session: Session) -> None:
+        try:
+            await session.stop()
+        except Exception:
+            logging.debug("Failed to stop media session", exc_info=True)
+
+    async def create_session(self, client: Client, dc_id: int) -> Session:
+        """
+        Creates and starts a media session for the DC, importing the authorization when
+        the DC is not the home DC of the client. CDN sessions need no authorization.
+        """
+        if self.is_cdn:
+            media_session = Session(
+                client,
+                dc_id,
+                await Auth(
+                    client, dc_id, await client.storage.test_mode()
+                ).create(),
+                await client.storage.test_mode(),
+                is_media=True,
+                is_cdn=True,
+            )
+            await media_session.start()
+        elif dc_id != await client.storage.dc_id():
+            media_session = Session(
+                client,
+                dc_id,
+                await Auth(
+                    client, dc_id, await client.storage.test_mode()
+                ).create(),
+                await client.storage.test_mode(),
+                is_media=True,
+            )
+            await media_session.start()
+
+            for _ in range(6):
+                exported_auth = await client.invoke(
+                    raw.functions.auth.ExportAuthorization(dc_id=dc_id)
+                )
+
+                try:
+                    await media_session.send(
+                        raw.functions.auth.ImportAuthorization(
+                            id=exported_auth.id, bytes=exported_auth.bytes
+                        )
+                    )
+                    break
+                except AuthBytesInvalid:
+                    logging.debug(
+                        f"Invalid authorization bytes for DC {dc_id}"
+                    )
+                    continue
+            else:
+                await media_session.stop()
+                raise AuthBytesInvalid
+        else:
+            media_session = Session(
+                client,
+                dc_id,
+                await client.storage.auth_key(),
+                await client.storage.test_mode(),
+                is_media=True,
+            )
+            await media_session.start()
+        self.created += 1
+        logging.debug(f"Created media session for DC {dc_id}")
+        return media_session
+
+
+media_sessions = MediaSessionPool(Var.MEDIA_SESSIONS)
+cdn_sessions = MediaSessionPool(Var.MEDIA_SESSIONS, is_cdn=True)
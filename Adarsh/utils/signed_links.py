@@ -0,0 +1,70 @@
+# (c) adarsh-goel
+import hmac
+import time
+import base64
+from hashlib import sha256
+from typing import Optional
+from Adarsh.vars import Var
+
+# bytes of the HMAC kept in a link, 96 bits is plenty against guessing
+MAC_SIZE = 12
+
+
+def _mac(message_id: int, expires: int) -> str:
+    digest = hmac.new(
+        Var.LINK_SECRET.encode(), f"{Var.BIN_CHANNEL}:{message_id}:{expires}".encode(), sha256
+    ).digest()
+    return base64.urlsafe_b64encode(digest[:MAC_SIZE]).decode()
+
+
+def sign(message_id: int, ttl: int = 0) -> str:
+    """
+    Returns the signature of a link to the message, valid for ttl seconds or forever when ttl is 0.
+    The expiry time comes first when there is one, like "1767225600.mac".
+    """
+    expires = int(time.time()) + ttl if ttl else 0
+    mac = _mac(message_id, expires)
+    return f"{expires}.{mac}" if expires else mac
+
+
+def verify(message_id: int, signature: str) -> bool:
+    """
+    Checks the signature of a link without asking Telegram, in constant time.
+    """
+    if not Var.LINK_SECRET:
+        return False
+    expires, _, mac = signature.rpartition(".")
+    if expires:
+        if not expires.isdigit() or int(expires) < time.time():
+            return False
+    return hmac.compare_digest(_mac(message_id, int(expires or 0)).encode(), mac.encode())
+
+
+def seconds_left(signature: Optional[str]) -> Optional[int]:
+    """
+    Returns the seconds a signed link stays valid, None for links that never expire.
+    """
+    if not signature:
+        return None
+    expires, _, _ = signature.rpartition(".")
+    if not expires.isdigit():
+        return None
+    return max(int(expires) - int(time.time()), 0)
+
+
+def link_query(message_id: int, secure_hash: str) -> str:
+    """
+    Returns the query string that authorizes a link to the message, signed when LINK_SECRET is set.
+    """
+    if Var.LINK_SECRET:
+        return f"sig={sign(message_id, Var.LINK_TTL)}"
+    return f"hash={secure_hash}"
+
+
+def link_path(file_id: int, secure_hash: Optional[str], signature: Optional[str]) -> str:
+    """
+    Returns the path of a link to the file, with the same kind of authorization as the request.
+    """
+    if signature:
+        return f"{file_id}?sig={signature}"
+    return f"{secure_hash}{file_id}"
@@ -0,0 +1,126 @@
+# (c) adarsh-goel
+import time
+import random
+import asyncio
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Optional
+from Adarsh.vars import Var
+
+logger = logging.getLogger("Adarsh.trace")
+
+
+class Trace:
+    def __init__(self, name: str):
+        """The time spent in each phase of a request, phases run more than once are added up.
+        A phase running in several tasks at once, like the parts read ahead, counts its wall-clock time once.
+        attributes:
+            name: what the request is, used in the log.
+            durations: seconds spent by phase name, in the order the phases started.
+            counts: how many times each phase ran.
+            first_byte: seconds until the first byte of the body was ready, None until then.
+        """
+        self.name = name
+        self.started = time.monotonic()
+        self.durations: Dict[str, float] = {}
+        self.counts: Dict[str, int] = {}
+        self.first_byte: Optional[float] = None
+        self.finished = False
+        # the spans of each phase running right now and since when one of them has been running
+        self._running: Dict[str, int] = {}
+        self._since: Dict[str, float] = {}
+        # how long the event loop takes to get back to us, a busy loop delays everything else
+        asyncio.get_running_loop().call_soon(self._loop_lag, self.started)
+
+    def _loop_lag(self, scheduled: float) -> None:
+        self.add("loop", time.monotonic() - scheduled)
+
+    def add(self, phase: str, seconds: float) -> None:
+        if self.finished:
+            # background work started by the request, like a prefetch, outlives it
+            return
+        self.durations[phase] = self.durations.get(phase, 0.0) + seconds
+        self.counts[phase] = self.counts.get(phase, 0) + 1
+
+    def enter(self, phase: str) -> None:
+        running = self._running.get(phase, 0)
+        if not running:
+            self._since[phase] = time.monotonic()
+        self._running[phase] = running + 1
+
+    def leave(self, phase: str) -> None:
+        running = self._running[phase] - 1
+        self._running[phase] = running
+        if not running:
+            self.add(phase, time.monotonic() - self._since[phase])
+        elif not self.finished:
+            self.counts[phase] = self.counts.get(phase, 0) + 1
+
+    def mark_first_byte(self) -> None:
+        if self.first_byte is None:
+            self.first_byte = time.monotonic() - self.started
+
+    def server_timing(self) -> str:
+        """
+        Returns the phases so far as a Server-Timing header value.
+        """
+        metrics = [f"{phase};dur={seconds * 1000:.1f}" for phase, seconds in self.durations.items()]
+        metrics.append(f"total;dur={(time.monotonic() - self.started) * 1000:.1f}")
+        return ", ".join(metrics)
+
+    def breakdown(self) -> str:
+        phases = " ".join(
+            f"{phase}={seconds * 1000:.1f}ms" + (f"x{self.counts[phase]}" if self.counts[phase] > 1 else "")
+            for phase, seconds in self.durations.items()
+        )
+        ttfb = f"{self.first_byte * 1000:.1f}ms" if self.first_byte is not None else "-"
+        return f"{self.name} ttfb={ttfb} total={(time.monotonic() - self.started) * 1000:.1f}ms {phases}"
+
+    def finish(self) -> None:
+        """
+        Logs the trace when it is slow, always with every phase, or when it is sampled.
+        """
+        if self.finished:
+            return
+        slow = Var.TRACE_SLOW and (self.first_byte or time.monotonic() - self.started) > Var.TRACE_SLOW
+        if slow:
+            logger.warning(f"Slow request {self.breakdown()}")
+        elif Var.TRACE_SAMPLE and random.random() < Var.TRACE_SAMPLE:
+            logger.info(self.breakdown())
+        self.finished = True
+
+
+current_trace: ContextVar[Optional[Trace]] = ContextVar("current_trace", default=None)
+
+
+def start_trace(name: str) -> Trace:
+    """
+    Starts the trace of the running request, the phases of the tasks it starts are added to it too.
+    """
+    trace = Trace(name)
+    current_trace.set(trace)
+    return trace
+
+
+def detach() -> None:
+    """
+    Stops a background task started by a request from adding its phases to the request.
+    """
+    current_trace.set(None)
+
+
+@contextmanager
+def span(phase: str):
+    """
+    Times a phase of the running request, does nothing outside of a traced request.
+    """
+    trace = current_trace.get()
+    if trace is None:
+        yield
+        return
+    trace.enter(phase)
+    try:
+        yield
+    finally:
+        trace.leave(phase)
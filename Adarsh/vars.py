@@ -15,6 +15,42 @@ class Var(object):
     name = str(getenv('SESSION_NAME', 'filetolinkbot'))
     SLEEP_THRESHOLD = int(getenv('SLEEP_THRESHOLD', '60'))
     WORKERS = int(getenv('WORKERS', '4'))
+    PARALLEL_PARTS = max(int(getenv('PARALLEL_PARTS', '4')), 1)
+    PART_RETRIES = int(getenv('PART_RETRIES', '4'))
+    DC_PROBE_INTERVAL = int(getenv('DC_PROBE_INTERVAL', '60'))  # seconds, 0 disables
+    CACHE_SIZE = int(getenv('CACHE_SIZE', '256'))  # MiB
+    PREFETCH_PARTS = int(getenv('PREFETCH_PARTS', '4'))
+    PREFETCH_BUDGET = int(getenv('PREFETCH_BUDGET', '64'))  # MiB
+    MIRROR_DIR = str(getenv('MIRROR_DIR', ''))
+    MIRROR_SIZE = int(getenv('MIRROR_SIZE', '10'))  # GiB
+    MIRROR_REQUESTS = int(getenv('MIRROR_REQUESTS', '3'))
+    ADMIN_TOKEN = str(getenv('ADMIN_TOKEN', ''))
+    LINK_SECRET = str(getenv('LINK_SECRET', ''))
+    LINK_TTL = int(getenv('LINK_TTL', '0'))  # seconds, 0 never expires
+    TRACE_SAMPLE = float(getenv('TRACE_SAMPLE', '0.01'))
+    TRACE_SLOW = float(getenv('TRACE_SLOW', '2'))  # seconds, 0 disables
+    BANDWIDTH_LIMIT = float(getenv('BANDWIDTH_LIMIT', '0'))  # MiB/s, 0 for no limit
+    IP_BANDWIDTH = float(getenv('IP_BANDWIDTH', '0'))  # MiB/s
+    LINK_BANDWIDTH = float(getenv('LINK_BANDWIDTH', '0'))  # MiB/s
+    PLAYBACK_RANGE = int(getenv('PLAYBACK_RANGE', '8'))  # MiB
+    PLAYBACK_WEIGHT = float(getenv('PLAYBACK_WEIGHT', '4'))
+    STREAM_LIMIT = int(getenv('STREAM_LIMIT', '100'))  # 0 for no limit
+    CLIENT_STREAM_LIMIT = int(getenv('CLIENT_STREAM_LIMIT', '0'))
+    IP_STREAM_LIMIT = int(getenv('IP_STREAM_LIMIT', '0'))
+    BUFFER_BUDGET = int(getenv('BUFFER_BUDGET', '512'))  # MiB
+    QUEUE_SIZE = int(getenv('QUEUE_SIZE', '50'))
+    QUEUE_TIMEOUT = float(getenv('QUEUE_TIMEOUT', '5'))  # seconds
+    MEDIA_SESSIONS = max(int(getenv('MEDIA_SESSIONS', '2')), 1)
+    WRITE_BUFFER = int(getenv('WRITE_BUFFER', str(1024 * 1024)))  # bytes
+    CLIENT_SCHEDULER = str(getenv('CLIENT_SCHEDULER', 'adaptive'))
+    FILE_CACHE_TTL = int(getenv('FILE_CACHE_TTL', '1800'))  # 30 minutes
+    FILE_CACHE_SIZE = int(getenv('FILE_CACHE_SIZE', '10000'))
+    BATCH_WINDOW = float(getenv('BATCH_WINDOW', '0.01'))  # seconds
+    MISSING_TTL = int(getenv('MISSING_TTL', '300'))  # 5 minutes
+    BAD_REQUEST_LIMIT = int(getenv('BAD_REQUEST_LIMIT', '0'))  # per minute and IP, 0 disables
+    TRUSTED_PROXIES = int(getenv('TRUSTED_PROXIES', '0'))
+    MEDIA_CACHE_CONTROL = str(getenv('MEDIA_CACHE_CONTROL', 'public, max-age=86400'))
+    PAGE_CACHE_CONTROL = str(getenv('PAGE_CACHE_CONTROL', 'public, max-age=3600'))
     BIN_CHANNEL = int(getenv('BIN_CHANNEL'))
     PORT = int(getenv('PORT', 8080))
     BIND_ADRESS = str(getenv('WEB_SERVER_BIND_ADDRESS', '0.0.0.0'))
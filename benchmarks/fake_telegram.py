@@ -0,0 +1,226 @@
+# (c) adarsh-goel
+"""
+A local stand-in for the parts of Telegram the streamer talks to: media sessions answering
+GetFile, GetCdnFile and GetCdnFileHashes, and clients answering get_messages.
+Every DC has a latency and a bandwidth shared by the requests of a session, and FloodWaits
+and CDN redirects can be injected.
+"""
+import time
+import random
+import asyncio
+import datetime
+from hashlib import sha256
+from types import SimpleNamespace
+from typing import Dict, List
+from pyrogram import raw
+from pyrogram.crypto import aes
+from pyrogram.errors import FloodWait
+from pyrogram.file_id import FileId, FileType
+from pyrogram.session.internals import DataCenter
+
+# content of every file, a file starts at its own offset in it so files differ
+PATTERN = random.Random(0).randbytes(1024 * 1024 + 7)
+PATTERN2 = PATTERN * 2
+# the CDN DC files are redirected to
+CDN_DC = 203
+HASH_BLOCK = 128 * 1024
+
+
+class DcProfile:
+    def __init__(self, latency: float, bandwidth: float):
+        """How fast a DC answers.
+        attributes:
+            latency: seconds before the first byte of an answer.
+            bandwidth: bytes per second a session receives.
+        """
+        self.latency = latency
+        self.bandwidth = bandwidth
+
+
+class FakeFile:
+    def __init__(self, message_id: int, dc_id: int, size: int, cdn: bool):
+        self.message_id = message_id
+        self.dc_id = dc_id
+        self.size = size
+        self.cdn = cdn
+        self.media_id = 5_000_000_000 + message_id
+        self.seed = message_id * 7919 % len(PATTERN)
+        self.file_id = FileId(
+            file_type=FileType.DOCUMENT,
+            dc_id=dc_id,
+            media_id=self.media_id,
+            access_hash=message_id,
+            file_reference=b"reference",
+        ).encode()
+        self.unique_id = sha256(str(message_id).encode()).hexdigest()[:16]
+        self.key = sha256(b"key" + self.unique_id.encode()).digest()
+        self.iv = sha256(b"iv" + self.unique_id.encode()).digest()[:16]
+
+    def read(self, offset: int, limit: int) -> bytes:
+        # parts never cross the end of the file and are at most 1 MiB, shorter than the pattern
+        length = max(min(limit, self.size - offset), 0)
+        start = (self.seed + offset) % len(PATTERN)
+        return PATTERN2[start:start + length]
+
+    def hashes(self, offset: int, blocks: int = 8) -> List[raw.types.FileHash]:
+        offset -= offset % HASH_BLOCK
+        return [
+            raw.types.FileHash(offset=block, limit=HASH_BLOCK, hash=sha256(self.read(block, HASH_BLOCK)).digest())
+            for block in range(offset, min(offset + blocks * HASH_BLOCK, self.size), HASH_BLOCK)
+        ]
+
+    def encrypt(self, data: bytes, offset: int) -> bytes:
+        iv = bytearray(self.iv[:-4] + (offset // 16).to_bytes(4, "big"))
+        return aes.ctr256_encrypt(data, self.key, iv)
+
+
+class FakeTelegram:
+    def __init__(
+        self,
+        profiles: Dict[int, DcProfile],
+        flood_rate: float = 0.0,
+        flood_seconds: int = 2,
+        session_setup: float = 0.3,
+        seed: int = 0,
+    ):
+        """The fake backend shared by every fake client and session.
+        attributes:
+            profiles: the DcProfile of every DC, also used for the CDN DC when it is in it.
+            flood_rate: the chance of a GetFile failing with a FloodWait.
+            flood_seconds: the value of the injected FloodWaits.
+            session_setup: seconds to create a media session, standing in for the auth export and import.
+            calls: the number of requests by query name.
+        """
+        self.profiles = profiles
+        self.flood_rate = flood_rate
+        self.flood_seconds = flood_seconds
+        self.session_setup = session_setup
+        self.random = random.Random(seed)
+        self.files: Dict[int, FakeFile] = {}
+        self._by_media: Dict[int, FakeFile] = {}
+        self.calls: Dict[str, int] = {}
+        self.floods = 0
+
+    def add_file(self, message_id: int, size: int, cdn: bool = False) -> FakeFile:
+        dcs = sorted(dc for dc in self.profiles if dc != CDN_DC)
+        fake_file = FakeFile(message_id, dcs[message_id % len(dcs)], size, cdn)
+        self.files[message_id] = fake_file
+        self._by_media[fake_file.media_id] = fake_file
+        return fake_file
+
+    def count(self, name: str) -> None:
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    def message(self, message_id: int) -> SimpleNamespace:
+        fake_file = self.files.get(message_id)
+        if fake_file is None:
+            return SimpleNamespace(id=message_id, empty=True)
+        document = SimpleNamespace(
+            file_id=fake_file.file_id,
+            file_unique_id=fake_file.unique_id,
+            file_size=fake_file.size,
+            mime_type="video/mp4",
+            file_name=f"file{message_id}.mp4",
+        )
+        return SimpleNamespace(
+            id=message_id,
+            empty=False,
+            date=datetime.datetime(2024, 1, 1),
+            document=document,
+        )
+
+    async def answer(self, session: "FakeSession", query) -> object:
+        if isinstance(query, raw.functions.upload.GetFile):
+            self.count("GetFile")
+            fake_file = self._by_media[query.location.id]
+            if self.flood_rate and self.random.random() < self.flood_rate:
+                self.floods += 1
+                raise FloodWait(value=self.flood_seconds)
+            if fake_file.cdn and query.cdn_supported:
+                self.count("CdnRedirect")
+                await session.transfer(0)
+                return raw.types.upload.FileCdnRedirect(
+                    dc_id=CDN_DC,
+                    file_token=str(fake_file.media_id).encode(),
+                    encryption_key=fake_file.key,
+                    encryption_iv=fake_file.iv,
+                    file_hashes=fake_file.hashes(0),
+                )
+            data = fake_file.read(query.offset, query.limit)
+            await session.transfer(len(data))
+            return raw.types.upload.File(type=raw.types.storage.FilePartial(), mtime=0, bytes=data)
+
+        if isinstance(query, raw.functions.upload.GetCdnFile):
+            self.count("GetCdnFile")
+            fake_file = self._by_media[int(query.file_token)]
+            data = fake_file.read(query.offset, query.limit)
+            await session.transfer(len(data))
+            return raw.types.upload.CdnFile(bytes=fake_file.encrypt(data, query.offset))
+
+        if isinstance(query, raw.functions.upload.GetCdnFileHashes):
+            self.count("GetCdnFileHashes")
+            await session.transfer(0)
+            return self._by_media[int(query.file_token)].hashes(query.offset)
+
+        raise NotImplementedError(f"The fake backend does not answer {type(query).__name__}")
+
+    async def create_session(self, client, dc_id: int) -> "FakeSession":
+        self.count("CreateSession")
+        # looked up like a real session does, a DC pyrogram has no address for fails here as it would
+        # against Telegram instead of getting a fake session
+        DataCenter(dc_id, False, False, True)
+        await asyncio.sleep(self.session_setup)
+        return FakeSession(self, self.profiles.get(dc_id, self.profiles[min(self.profiles)]))
+
+
+class FakeSession:
+    def __init__(self, backend: FakeTelegram, profile: DcProfile):
+        """A media session, the answers of one session share its bandwidth and arrive in order."""
+        self.backend = backend
+        self.profile = profile
+        self.is_connected = asyncio.Event()
+        self.is_connected.set()
+        self._busy_until = 0.0
+
+    async def transfer(self, length: int) -> None:
+        now = time.monotonic()
+        start = max(now, self._busy_until)
+        self._busy_until = start + length / self.profile.bandwidth
+        await asyncio.sleep(self._busy_until - now + self.profile.latency)
+
+    async def send(self, query, *args, **kwargs):
+        return await self.backend.answer(self, query)
+
+    async def stop(self) -> None:
+        self.is_connected.clear()
+
+
+class FakeClient:
+    def __init__(self, backend: FakeTelegram, name: str, latency: float = 0.05):
+        """A bot client, only get_messages is answered."""
+        self.backend = backend
+        self.name = name
+        self.username = name
+        self.latency = latency
+
+    async def get_messages(self, chat_id: int, message_ids):
+        self.backend.count("GetMessages")
+        await asyncio.sleep(self.latency)
+        if isinstance(message_ids, int):
+            return self.backend.message(message_ids)
+        return [self.backend.message(message_id) for message_id in message_ids]
+
+    def __repr__(self) -> str:
+        return f"FakeClient({self.name})"
+
+
+def default_profiles() -> Dict[int, DcProfile]:
+    # rough numbers of a server in Europe, DC 4 is the home DC
+    return {
+        1: DcProfile(0.12, 6 * 2 ** 20),
+        2: DcProfile(0.05, 10 * 2 ** 20),
+        4: DcProfile(0.03, 12 * 2 ** 20),
+        5: DcProfile(0.2, 4 * 2 ** 20),
+        CDN_DC: DcProfile(0.02, 20 * 2 ** 20),
+    }
+
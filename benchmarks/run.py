@@ -0,0 +1,274 @@
+# (c) adarsh-goel
+"""
+Load test of the real aiohttp app against the fake Telegram backend of fake_telegram.py.
+
+    python -m benchmarks.run                      # run and compare with benchmarks/baseline.json
+    python -m benchmarks.run --save-baseline      # run and store the results as the new baseline
+    python -m benchmarks.run --env CACHE_SIZE=0   # run with a setting of Var changed
+
+Virtual viewers pick files by a Zipf law and run a mix of workloads:
+    player    back to back 1 MiB Range requests from a random offset, like a video player
+    seek      a 64 KiB Range request at a random offset
+    head      a HEAD request
+    download  a full GET of the file
+The viewers run in the same process as the server, so compare runs made on the same machine.
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import logging
+import resource
+from typing import Dict, List, Optional
+
+BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+# results compared with the baseline, and whether higher is better
+COMPARED = {
+    "throughput_mib_s": True,
+    "ttfb_p50_ms": False,
+    "ttfb_p99_ms": False,
+    "get_file_per_mib": False,
+    "peak_rss_mib": False,
+}
+WORKLOADS = ("player", "seek", "head", "download")
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark the streamer against a fake Telegram backend")
+    parser.add_argument("--duration", type=float, default=20, help="seconds of load")
+    parser.add_argument("--viewers", type=int, default=32, help="concurrent virtual viewers")
+    parser.add_argument("--clients", type=int, default=2, help="bot clients")
+    parser.add_argument("--files", type=int, default=100, help="files in the bin channel")
+    parser.add_argument("--file-size", type=float, default=32, help="average file size in MiB")
+    parser.add_argument("--mix", default="player=6,seek=2,head=1,download=1", help="workload weights")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="chance of a GetFile FloodWait")
+    parser.add_argument("--flood-seconds", type=int, default=2, help="value of the injected FloodWaits")
+    parser.add_argument(
+        "--cdn-rate", type=float, default=0.2,
+        help="share of files Telegram redirects to a CDN DC, only while the streamer offers the CDN",
+    )
+    parser.add_argument(
+        "--dc", action="append", default=[], metavar="DC=LATENCY_MS:MBPS",
+        help="latency and bandwidth of a DC, like 4=30:100, can be repeated",
+    )
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="a setting of Var")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--baseline", default=BASELINE, help="baseline file to compare with")
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="relative change reported as a regression")
+    return parser.parse_args(argv)
+
+
+def setup_environment(args: argparse.Namespace) -> None:
+    # Var reads the environment once on import, the app must be imported after this
+    os.environ.update(
+        API_ID="1", API_HASH="benchmark", BOT_TOKEN="1:benchmark", BIN_CHANNEL="-1001", DATABASE_URL="mongodb://localhost"
+    )
+    for setting in args.env:
+        key, _, value = setting.partition("=")
+        os.environ[key] = value
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+class Viewer:
+    def __init__(self, session, url: str, files: Dict[int, object], weights: List[float], mix: Dict[str, int], rng):
+        self.session = session
+        self.url = url
+        self.files = files
+        self.ids = list(files)
+        self.weights = weights
+        self.workloads = list(mix)
+        self.mix = list(mix.values())
+        self.rng = rng
+        self.ttfb: List[float] = []
+        self.received = 0
+        self.requests: Dict[str, int] = dict.fromkeys(WORKLOADS, 0)
+        self.errors = 0
+
+    async def get(self, link: str, method: str = "GET", range: Optional[str] = None) -> None:
+        headers = {"Range": range} if range else {}
+        started = time.monotonic()
+        try:
+            async with self.session.request(method, self.url + link, headers=headers) as resp:
+                if resp.status >= 400:
+                    self.errors += 1
+                first = True
+                async for chunk in resp.content.iter_any():
+                    if first:
+                        # headers go out before the first part arrives, the first body byte is what a viewer waits for
+                        self.ttfb.append(time.monotonic() - started)
+                        first = False
+                    self.received += len(chunk)
+                if first:
+                    self.ttfb.append(time.monotonic() - started)
+        except Exception as e:
+            logging.debug(f"Request failed: {e!r}")
+            self.errors += 1
+
+    async def run(self, deadline: float) -> None:
+        while time.monotonic() < deadline:
+            message_id = self.rng.choices(self.ids, self.weights)[0]
+            fake_file = self.files[message_id]
+            link = f"{fake_file.unique_id[:6]}{message_id}"
+            workload = self.rng.choices(self.workloads, self.mix)[0]
+            self.requests[workload] += 1
+            if workload == "player":
+                offset = self.rng.randrange(0, fake_file.size)
+                for _ in range(4):
+                    if offset >= fake_file.size or time.monotonic() >= deadline:
+                        break
+                    await self.get(link, range=f"bytes={offset}-{offset + 2 ** 20 - 1}")
+                    offset += 2 ** 20
+            elif workload == "seek":
+                offset = self.rng.randrange(0, fake_file.size)
+                await self.get(link, range=f"bytes={offset}-{offset + 2 ** 16 - 1}")
+            elif workload == "head":
+                await self.get(link, method="HEAD")
+            else:
+                await self.get(link)
+
+
+async def benchmark(args: argparse.Namespace) -> dict:
+    import aiohttp
+    from aiohttp import web
+    from benchmarks.fake_telegram import FakeClient, FakeTelegram, DcProfile, default_profiles
+    # the server package must come first, the utils import it back
+    from Adarsh.server import web_server
+    from Adarsh.bot import multi_clients, work_loads, StreamBot
+    from Adarsh.utils.session_pool import media_sessions, cdn_sessions
+
+    logging.getLogger().setLevel(logging.WARNING)
+    profiles = default_profiles()
+    for setting in args.dc:
+        dc_id, _, profile = setting.partition("=")
+        latency, bandwidth = profile.split(":")
+        profiles[int(dc_id)] = DcProfile(float(latency) / 1000, float(bandwidth) * 1e6 / 8)
+
+    rng = random.Random(args.seed)
+    backend = FakeTelegram(profiles, args.flood_rate, args.flood_seconds, seed=args.seed)
+    files = {}
+    for message_id in range(1, args.files + 1):
+        size = int(args.file_size * 2 ** 20 * rng.uniform(0.5, 1.5))
+        files[message_id] = backend.add_file(message_id, size, cdn=rng.random() < args.cdn_rate)
+    # Zipf, a few files get most of the views
+    weights = [1 / rank ** 1.1 for rank in range(1, args.files + 1)]
+
+    media_sessions.create_session = backend.create_session
+    cdn_sessions.create_session = backend.create_session
+    multi_clients.clear()
+    work_loads.clear()
+    for index in range(args.clients):
+        multi_clients[index] = FakeClient(backend, f"bot{index + 1}")
+        work_loads[index] = 0
+    StreamBot.username = "benchmark_bot"
+
+    runner = web.AppRunner(await web_server(), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+
+    mix = {}
+    for weight in args.mix.split(","):
+        name, _, value = weight.partition("=")
+        if name not in WORKLOADS:
+            raise SystemExit(f"Unknown workload {name}, use one of {', '.join(WORKLOADS)}")
+        mix[name] = int(value)
+
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=None)) as session:
+        viewers = [
+            Viewer(session, f"http://127.0.0.1:{port}/", files, weights, mix, random.Random(rng.random()))
+            for _ in range(args.viewers)
+        ]
+        started = time.monotonic()
+        await asyncio.gather(*(viewer.run(started + args.duration) for viewer in viewers))
+        elapsed = time.monotonic() - started
+
+    await media_sessions.stop()
+    await cdn_sessions.stop()
+    await runner.cleanup()
+
+    received = sum(viewer.received for viewer in viewers)
+    ttfb = [t for viewer in viewers for t in viewer.ttfb]
+    parts = backend.calls.get("GetFile", 0) + backend.calls.get("GetCdnFile", 0)
+    return {
+        "requests": dict((name, sum(viewer.requests[name] for viewer in viewers)) for name in WORKLOADS),
+        "http_requests": len(ttfb),
+        "errors": sum(viewer.errors for viewer in viewers),
+        "seconds": round(elapsed, 2),
+        "received_mib": round(received / 2 ** 20, 1),
+        "throughput_mib_s": round(received / 2 ** 20 / elapsed, 2),
+        "ttfb_p50_ms": round(percentile(ttfb, 0.5) * 1000, 1),
+        "ttfb_p99_ms": round(percentile(ttfb, 0.99) * 1000, 1),
+        "get_file_per_mib": round(parts / max(received / 2 ** 20, 1e-9), 3),
+        # kilobytes on Linux
+        "peak_rss_mib": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "telegram_calls": backend.calls,
+        "flood_waits": backend.floods,
+    }
+
+
+def config_of(args: argparse.Namespace) -> dict:
+    return dict(
+        (key, value)
+        for key, value in vars(args).items()
+        if key not in ("baseline", "save_baseline", "tolerance")
+    )
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> List[str]:
+    """
+    Prints the results next to the baseline and returns the regressed results.
+    """
+    regressions = []
+    print(f"{'':18}{'baseline':>12}{'now':>12}{'change':>10}")
+    for key, higher_is_better in COMPARED.items():
+        old, new = baseline.get(key), results[key]
+        if not old:
+            print(f"{key:18}{'-':>12}{new:>12}")
+            continue
+        change = (new - old) / old
+        worse = -change if higher_is_better else change
+        flag = "  REGRESSION" if worse > tolerance else ""
+        if flag:
+            regressions.append(key)
+        print(f"{key:18}{old:>12}{new:>12}{change:>+10.1%}{flag}")
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    setup_environment(args)
+    results = asyncio.run(benchmark(args))
+    print(json.dumps(results, indent=2))
+
+    config = config_of(args)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump({"config": config, "results": results}, f, indent=2)
+            f.write("\n")
+        print(f"Saved the baseline to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("No baseline to compare with, store one with --save-baseline")
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline["config"] != config:
+        print("The baseline was made with other options, the comparison is only indicative")
+    return 1 if compare(results, baseline["results"], args.tolerance) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())